@@ -1,7 +1,15 @@
 import base64
+import hashlib 
+import marshal 
+import os 
+import re 
+import threading 
+import time 
+from collections import OrderedDict
 from random import random 
 from io import StringIO, BytesIO
 from struct import pack 
+from time import perf_counter 
 
 
 ALPHABET = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
@@ -21,7 +29,281 @@ def offset(letter):
 
 def offsets(letters):
     return (offset(x) for x in letters)
+
+
+def key_code(letter):
+    # Index of the letter that push_key feeds into the machine, or -1 if 
+    # the character is passed through without stepping the rotors.
+    if not letter.strip():
+        return -1
+    letter = letter.upper()
+    if letter not in ALPHABET:
+        letter = "X"
+    code = ALPHABET.find(letter)
+    if len(letter) != 1:
+        # Characters like the st-ligature upper-case to several letters 
+        # which push_key encrypts as their first letter, skipping the plugboard.
+        code += len(ALPHABET)
+    return code
+
+
+# key_code of every byte read as a Latin-1 character
+_byte_codes = tuple(key_code(chr(x)) for x in range(256))
+
+
+_wiring_tables = {}
+
+
+def wiring_tables(in_map, out_map):
+    # Forward and backward substitution of a wheel for every offset between 
+    # its rotation and its ring setting, indexed as table[offset][letter].
+    key = (in_map, out_map)
+    if key not in _wiring_tables:
+        size = len(in_map)
+        wiring = [in_map.find(x) for x in out_map]
+        inverse = [0]*size
+        for i, x in enumerate(wiring):
+            inverse[x] = i
+        
+        forward = tuple(
+            tuple((wiring[(letter+k) % size] - k) % size for letter in range(size))
+            for k in range(size))
+        backward = tuple(
+            tuple((inverse[(letter+k) % size] - k) % size for letter in range(size))
+            for k in range(size))
+        _wiring_tables[key] = (forward, backward)
     
+    return _wiring_tables[key]
+
+
+def import_numpy():
+    # numpy is only needed for the vectorized paths, so it is imported on demand
+    try:
+        import numpy
+    except ImportError:
+        raise RuntimeError("This feature requires numpy to be installed")
+    return numpy
+
+
+def step_offsets(offsets, notches, stepping):
+    # Integer version of the stepping done by push_key. Rotors are listed from 
+    # right to left and notches are given relative to the ring setting.
+    carry = True 
+    for i in range(len(offsets)):
+        at_notch = offsets[i] in notches[i]
+        if carry:
+            if stepping[i]:
+                offsets[i] = (offsets[i]+1) % 26
+            carry = at_notch
+        elif i == 1:
+            # Double-stepping of the middle rotor
+            if at_notch:
+                offsets[i] = (offsets[i]+1) % 26
+            carry = at_notch
+        else:
+            break 
+
+
+def step_offsets_array(offsets, notches, stepping):
+    # numpy version of step_offsets that steps many machines at once. offsets 
+    # has one row per rotor (right to left) and one column per machine, the 
+    # notches of a rotor can be ints or arrays with one entry per machine.
+    carry = None 
+    for i in range(len(offsets)):
+        at_notch = offsets[i] < 0  # all False
+        for notch in notches[i]:
+            at_notch |= offsets[i] == notch
+        
+        if i == 0:
+            move = stepping[0]
+            carry = at_notch
+        elif i == 1:
+            # Double-stepping of the middle rotor
+            move = (carry & stepping[1]) | at_notch
+            carry = at_notch
+        else:
+            move = carry & stepping[i]
+            carry = carry & at_notch
+        
+        offsets[i] += move 
+        offsets[i] %= 26
+
+
+def step_events(offsets, notches, stepping, count):
+    # Steps the rotors through count key presses, but only visits the key 
+    # presses that move a rotor other than the rightmost one. Yields the key 
+    # index and the offsets of the other rotors after that key press. 
+    # offsets is left at the state after the last key press.
+    if not offsets:
+        return 
+    
+    right = offsets[0]
+    right_step = 1 if stepping[0] else 0
+    key = 0
+    while key < count:
+        if len(offsets) > 1 and offsets[1] in notches[1]:
+            # The middle rotor double-steps on the next key press 
+            event = key 
+        else:
+            distances = [(x - right - key*right_step) % 26 for x in notches[0]]
+            if not distances or not right_step:
+                break 
+            event = key + min(distances)
+            if event >= count:
+                break 
+        
+        offsets[0] = (right + event*right_step) % 26
+        step_offsets(offsets, notches, stepping)
+        yield event, tuple(offsets[1:])
+        key = event+1
+    
+    offsets[0] = (right + count*right_step) % 26
+
+
+
+def offset_positions(offsets, notches, stepping, count):
+    # Rotor offsets after each of count key presses as an array with one 
+    # row per rotor (right to left) and one column per key press, laid out 
+    # from the step_events between them. offsets is moved on like there.
+    np = import_numpy()
+    positions = np.empty((len(offsets), count), dtype=np.intp)
+    if not offsets:
+        return positions 
+    right = offsets[0]
+    start = tuple(offsets[1:])
+    events = list(step_events(offsets, notches, stepping, count))
+    right_step = 1 if stepping[0] else 0
+    positions[0] = (right + (np.arange(count)+1)*right_step) % 26
+    if len(offsets) > 1:
+        event_keys = np.array([key for key, state in events], dtype=np.intp)
+        states = np.array([start] + [state for key, state in events], dtype=np.intp)
+        current = np.searchsorted(event_keys, np.arange(count), side="right")
+        positions[1:] = states[current].T
+    return positions 
+
+_stepping_orbits = OrderedDict()
+_stepping_lock = threading.Lock()
+
+
+def stepping_orbit(offsets, notches, stepping):
+    # The rightmost rotor is back at the same offset every 26 key presses, so 
+    # the states sampled every 26 key presses only depend on the other rotors 
+    # and run into a cycle after at most 26**(rotors-1) samples. Returns a 
+    # list of samples, the index of the given offsets in it and the index 
+    # where the cycle starts, the sample after the last one is the one at 
+    # the cycle start. Orbits are cached per notches and stepping, like 
+    # stepping_cycle does, and found from every sample on them, so one orbit 
+    # serves all start positions it passes through.
+    start = tuple(offsets)
+    states = _stepping_orbits.get((notches, stepping))
+    if states is not None:
+        found = states.get(start)
+        if found is not None:
+            return found 
+    
+    state = list(offsets)
+    seen = {}
+    orbit = []
+    while tuple(state) not in seen and (states is None or tuple(state) not in states):
+        seen[tuple(state)] = len(orbit)
+        orbit.append(tuple(state))
+        for event in step_events(state, notches, stepping, 26):
+            pass 
+    
+    new = len(orbit)
+    if tuple(state) in seen:
+        cycle_start = seen[tuple(state)]
+    else:
+        # Ran into a cached orbit, which is continued from that sample on 
+        known, index, known_start = states[tuple(state)]
+        if index < known_start:
+            cycle_start = new + known_start - index 
+            orbit.extend(known[index:])
+        else:
+            cycle_start = new 
+            orbit.extend(known[index:])
+            orbit.extend(known[known_start:index])
+    
+    with _stepping_lock:
+        states = _stepping_orbits.setdefault((notches, stepping), {})
+        _stepping_orbits.move_to_end((notches, stepping))
+        while len(_stepping_orbits) > 256:
+            _stepping_orbits.popitem(last=False)
+        for i in range(new):
+            states[orbit[i]] = (orbit, i, cycle_start)
+    return orbit, 0, cycle_start
+
+
+def offsets_after(offsets, notches, stepping, count):
+    # Offsets after count key presses, without stepping through all of them
+    orbit, index, cycle_start = stepping_orbit(offsets, notches, stepping)
+    rounds, rest = divmod(count, 26)
+    sample = index + rounds 
+    if sample >= len(orbit):
+        sample = cycle_start + (sample - cycle_start) % (len(orbit) - cycle_start)
+    
+    state = list(orbit[sample])
+    for event in step_events(state, notches, stepping, rest):
+        pass 
+    return state
+
+
+_stepping_cycles = {}
+
+
+def stepping_cycle(offsets, notches, stepping):
+    # The rotor offsets of every machine run into a cycle, possibly after a 
+    # few key presses that cannot be repeated because of the double step. 
+    # Returns the number of key presses before the cycle is reached, the 
+    # offsets along the cycle as an array with one row per rotor (right to 
+    # left) and one column per key press, and the column reached after the 
+    # tail. Cycles are cached per notches and stepping, which only depend 
+    # on wheel order and ring settings, and are shared by all states on them.
+    np = import_numpy()
+    if (notches, stepping) not in _stepping_cycles and len(_stepping_cycles) >= 256:
+        _stepping_cycles.clear()
+    cycles = _stepping_cycles.setdefault((notches, stepping), {})
+    if tuple(offsets) in cycles:
+        cycle, index = cycles[tuple(offsets)]
+        return 0, cycle, index 
+    
+    if not offsets or not stepping[0]:
+        # Nothing ever moves 
+        cycle = np.array(offsets, dtype=np.uint8).reshape(-1, 1)
+        cycles[tuple(offsets)] = (cycle, 0)
+        return 0, cycle, 0
+    
+    # The state sampled at cycle_start*26 key presses is on the cycle and 
+    # the one before is not, so the tail ends in the 26 key presses between
+    orbit, index, cycle_start = stepping_orbit(offsets, notches, stepping)
+    period = 26*(len(orbit) - cycle_start)
+    tail = 0
+    if cycle_start > index:
+        before = list(orbit[cycle_start-1])
+        later = offsets_after(before, notches, stepping, period)
+        key = 0
+        while before != later:
+            step_offsets(before, notches, stepping)
+            step_offsets(later, notches, stepping)
+            key += 1
+        tail = 26*(cycle_start-1-index) + key 
+    start = offsets_after(offsets, notches, stepping, tail)
+    
+    # Offsets of all key presses of the cycle from the event stepping used 
+    # by encode_vectorized, starting with the state reached after the tail
+    state = list(start)
+    events = list(step_events(state, notches, stepping, period - 1))
+    cycle = np.empty((len(start), period), dtype=np.uint8)
+    cycle[0] = (start[0] + np.arange(period)) % 26
+    if len(start) > 1:
+        event_keys = np.array([key+1 for key, value in events], dtype=np.intp)
+        states = np.array([start[1:]] + [value for key, value in events], dtype=np.intp)
+        cycle[1:] = states[np.searchsorted(event_keys, np.arange(period), side="right")].T
+    
+    for index, column in enumerate(cycle.T.tolist()):
+        cycles[tuple(column)] = (cycle, index)
+    return tail, cycle, 0
+
 
 class RotorPiece(object):
     def __init__(self, in_map, out_map, ring_setting, turnover_at, turnover_at2=None):
@@ -71,6 +353,9 @@ class RotorPiece(object):
         
     def turnover(self):
         return self.rotation == self.turnover_at or self.rotation == self.turnover_at2
+    
+    def spec(self):
+        return RotorSpec(self.in_map, self.out_map, self.ring_setting, self.turnover_at, self.turnover_at2)
 
 
 class NonRotatableRotor(RotorPiece):
@@ -81,6 +366,9 @@ class NonRotatableRotor(RotorPiece):
     def turnover(self):
         return False 
     
+    def spec(self):
+        return RotorSpec(self.in_map, self.out_map, self.ring_setting, stepping=False)
+    
     
 class Stator(NonRotatableRotor):
     def __init__(self, in_map, out_map):
@@ -92,13 +380,292 @@ class Reflector(RotorPiece):
         super().__init__(in_map, out_map, ring_setting, turnover_at, turnover_at2)
 
 
+class RotorSpec(object):
+    # Immutable wiring, notches and ring setting of a wheel. The rotation is 
+    # kept by the machine, so one spec can be shared by any number of machines.
+    __slots__ = ("in_map", "out_map", "ring_setting", "turnover_at", "turnover_at2", "stepping")
+    
+    def __init__(self, in_map, out_map, ring_setting=0, turnover_at=None, turnover_at2=None, stepping=True):
+        for name, value in zip(self.__slots__, (in_map, out_map, ring_setting, turnover_at, turnover_at2, stepping)):
+            object.__setattr__(self, name, value)
+    
+    def __setattr__(self, name, value):
+        raise AttributeError("RotorSpec is immutable, use with_ring to change the ring setting")
+    
+    def __reduce__(self):
+        return (RotorSpec, self._fields())
+    
+    def __eq__(self, other):
+        return isinstance(other, RotorSpec) and self._fields() == other._fields()
+    
+    def __hash__(self):
+        return hash(self._fields())
+    
+    def _fields(self):
+        return (self.in_map, self.out_map, self.ring_setting, self.turnover_at, self.turnover_at2, self.stepping)
+    
+    def with_ring(self, ring_setting):
+        return RotorSpec(self.in_map, self.out_map, ring_setting, self.turnover_at, self.turnover_at2, self.stepping)
+    
+    def advance(self, rotation):
+        if not self.stepping:
+            return rotation 
+        return (rotation+1) % len(self.in_map)
+    
+    def turnover(self, rotation):
+        return self.stepping and (rotation == self.turnover_at or rotation == self.turnover_at2)
+    
+    def encode(self, letter, rotation=0):
+        #ring setting acts like a inverse offset
+        ring_offset = len(self.in_map) - self.ring_setting 
+        pos = (self.in_map.find(letter) + rotation + ring_offset) % len(self.in_map)
+        outpos = self.in_map.find(self.out_map[pos])
+        outpos = (outpos + (len(self.in_map) - rotation) + self.ring_setting ) % len(self.in_map)
+        return self.in_map[outpos]
+        
+    def encode_back(self, letter, rotation=0):
+        ring_offset = len(self.in_map) - self.ring_setting 
+        pos = (self.in_map.find(letter) + rotation + ring_offset) % len(self.in_map)
+        inpos = self.out_map.find(self.in_map[pos])
+        inpos = (inpos + (len(self.in_map) - rotation) + self.ring_setting ) % len(self.in_map)
+        return self.in_map[inpos]
+    
+    def tables(self):
+        return wiring_tables(self.in_map, self.out_map)
+    
+    def offset(self, rotation):
+        return (rotation - self.ring_setting) % len(self.in_map)
+    
+    def notches(self):
+        # Window positions at which the next rotor is carried, relative to 
+        # the ring setting like offset()
+        if not self.stepping:
+            return ()
+        return tuple((x - self.ring_setting) % len(self.in_map) 
+            for x in (self.turnover_at, self.turnover_at2) if x is not None)
+
+
+def split_piece(piece):
+    # Spec and rotation of a wheel given either as a RotorSpec or as a RotorPiece
+    if isinstance(piece, RotorSpec):
+        return piece, 0
+    return piece.spec(), piece.rotation
+
+
+class MachineState(object):
+    # Rotations of the rotors from left to right, and of the reflector
+    __slots__ = ("rotations", "reflector")
+    
+    def __init__(self, rotations, reflector=0):
+        self.rotations = list(rotations)
+        self.reflector = reflector 
+    
+    def copy(self):
+        return MachineState(self.rotations, self.reflector)
+
+
+class PermutationCache(object):
+    # Least recently used cache of the substitution a machine does in one 
+    # rotor state, from key code to output letter. Keys are integers, every 
+    # wiring of wheels, plugboard and ETW gets its own range of them from 
+    # base, so a cache can be shared by differently configured machines, 
+    # also from several threads. Lookups take no lock, and only one hit in 
+    # RECENCY_SAMPLE moves its entry to the end, which keeps the order close 
+    # to least recently used without any bookkeeping on most hits.
+    RECENCY_SAMPLE = 64
+    
+    def __init__(self, maxsize=65536, max_wirings=4096):
+        self.maxsize = maxsize 
+        self.max_wirings = max_wirings 
+        self.hits = 0
+        self.misses = 0
+        self._permutations = OrderedDict()
+        self._bases = OrderedDict()
+        self._next_base = 0
+        self._lock = threading.Lock()
+    
+    def __getstate__(self):
+        # Locks cannot be pickled, a copy sent to another process gets its own 
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state 
+    
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+    
+    def __len__(self):
+        return len(self._permutations)
+    
+    def base(self, wiring, size):
+        # First of the size keys of wiring. Ranges are never handed out 
+        # twice, so when a wiring is dropped to bound memory its entries 
+        # just age out.
+        base = self._bases.get(wiring)
+        if base is None:
+            with self._lock:
+                base = self._bases.get(wiring)
+                if base is None:
+                    base = self._bases[wiring] = self._next_base 
+                    self._next_base += size 
+                    while len(self._bases) > self.max_wirings:
+                        self._bases.popitem(last=False)
+        return base 
+    
+    def get(self, key):
+        permutation = self._permutations.get(key)
+        if permutation is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            if not self.hits % self.RECENCY_SAMPLE:
+                with self._lock:
+                    if key in self._permutations:
+                        self._permutations.move_to_end(key)
+        return permutation 
+    
+    def put(self, key, permutation):
+        with self._lock:
+            self._permutations[key] = permutation
+            self._permutations.move_to_end(key)
+            while len(self._permutations) > self.maxsize:
+                self._permutations.popitem(last=False)
+    
+    def clear(self):
+        with self._lock:
+            self._permutations.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+class TableCache(object):
+    # Tables of the wheels on disk, named by a hash of their wiring and 
+    # stepping. Ring settings, rotor positions, ETW and plugboard are not 
+    # part of them, so one file serves every daily key of a wheel order, 
+    # the plugboard and ETW are put in front after loading. Files unused 
+    # for max_age seconds and the least recently used ones beyond 
+    # max_files are removed whenever a new file is written.
+    VERSION = 2
+    
+    def __init__(self, directory=None, max_files=1024, max_age=90*24*3600):
+        if directory is None:
+            directory = os.environ.get("ENIGMA_CACHE_DIR") or os.path.join(
+                os.path.expanduser("~"), ".cache", "enigma")
+        self.directory = directory 
+        self.max_files = max_files 
+        self.max_age = max_age 
+    
+    def path(self, machine):
+        content = repr((self.VERSION, 
+            [(rotor.in_map, rotor.out_map, rotor.stepping) for rotor in machine.rotors], 
+            (machine.reflector.in_map, machine.reflector.out_map)))
+        name = hashlib.sha256(content.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, name + ".tables")
+    
+    def load(self, machine):
+        path = self.path(machine)
+        try:
+            with open(path, "rb") as f:
+                # marshal.load reads a file object in small pieces, this is much faster
+                tables = marshal.loads(f.read())
+        except (OSError, EOFError, ValueError, TypeError):
+            return None 
+        try:
+            # The modification time tells when a file was last used
+            os.utime(path)
+        except OSError:
+            pass 
+        return tables 
+    
+    def store(self, machine, tables):
+        # Written under a temporary name, so readers never see a partial 
+        # file. A cache that cannot be written is ignored.
+        path = self.path(machine)
+        temporary = "{0}.{1}.tmp".format(path, os.getpid())
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(temporary, "wb") as f:
+                f.write(marshal.dumps(tables))
+            os.replace(temporary, path)
+        except OSError:
+            return 
+        self.prune()
+    
+    def prune(self):
+        # Removes files older than max_age and then the oldest ones beyond 
+        # max_files. Files removed by another process meanwhile are skipped.
+        files = []
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return 
+        for name in names:
+            if name.endswith(".tables"):
+                path = os.path.join(self.directory, name)
+                try:
+                    files.append((os.stat(path).st_mtime, path))
+                except OSError:
+                    pass 
+        
+        files.sort(reverse=True)
+        limit = time.time() - self.max_age 
+        for i, (mtime, path) in enumerate(files):
+            if i >= self.max_files or mtime < limit:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass 
+
+
+class Metrics(object):
+    # Counters and seconds spent per stage, filled in by instrumented 
+    # machines and codecs. One instance can be shared by several of them.
+    def __init__(self):
+        self.keystrokes = 0
+        self.advances = {} # rotor index from the left -> steps 
+        self.double_steps = 0
+        self.turnovers = 0
+        self.plugboard_hits = 0
+        self.substitutions = 0 # characters replaced by X 
+        self.timings = {}
+    
+    def add_time(self, stage, seconds):
+        self.timings[stage] = self.timings.get(stage, 0.0) + seconds 
+    
+    def reset(self):
+        self.__init__()
+    
+    def snapshot(self):
+        return {"keystrokes": self.keystrokes, "advances": dict(self.advances), 
+            "double_steps": self.double_steps, "turnovers": self.turnovers, 
+            "plugboard_hits": self.plugboard_hits, "substitutions": self.substitutions, 
+            "timings": dict(self.timings)}
+
+
 class EnigmaMachine(object):
-    def __init__(self, reflector=None, rotors=[], etw=None, plugboard=None, rotatable_reflector=False):
+    def __init__(self, reflector=None, rotors=[], etw=None, plugboard=None, rotatable_reflector=False,
+                 permutation_cache=None):
+        # The machine only keeps immutable specs of the wheels it is given, 
+        # so wheels can be shared between machines without affecting each other.
         self.rotors = []
+        rotations = []
         for rotor in rotors:
-            self.rotors.append(rotor)
-        self.etw = etw 
-        self.reflector = reflector 
+            spec, rotation = split_piece(rotor)
+            self.rotors.append(spec)
+            rotations.append(rotation)
+        
+        self.etw = None 
+        if etw is not None:
+            # The ETW never moves, so its rotation can be folded into the ring setting
+            spec, rotation = split_piece(etw)
+            self.etw = spec.with_ring((spec.ring_setting - rotation) % len(spec.in_map))
+        
+        self.reflector = None 
+        reflector_rotation = 0
+        if reflector is not None:
+            self.reflector, reflector_rotation = split_piece(reflector)
+        self.state = MachineState(rotations, reflector_rotation)
+        
         self.plugboard = {}
         if plugboard is not None:
             for a,b in plugboard:
@@ -109,6 +676,459 @@ class EnigmaMachine(object):
                 self.plugboard[b] = a
         
         self.rotatable_reflector = rotatable_reflector
+        self.permutation_cache = permutation_cache
+        self._compiled = None 
+        self._key_path = None 
+    
+    def clone(self):
+        # Copy that shares wiring, plugboard and compiled tables but has its own rotor positions
+        machine = type(self).__new__(type(self))
+        machine.__dict__.update(self.__dict__)
+        machine.state = self.state.copy()
+        return machine 
+    
+    def snapshot(self):
+        return (self.state.reflector,) + tuple(self.state.rotations)
+    
+    def restore(self, snapshot):
+        self.state.reflector = snapshot[0]
+        self.state.rotations[:] = snapshot[1:]
+    
+    def compile(self, cache=None):
+        # Switch the machine to precomputed integer tables. Rotor positions 
+        # and ring settings can still be changed, but the plugboard and ETW 
+        # are fixed at this point. With a TableCache the tables of the 
+        # wheels are read from disk if the same wheels were compiled before.
+        if cache is None:
+            self._compiled = self._build_tables()
+            return self 
+        
+        wheels = cache.load(self)
+        if wheels is None:
+            wheels = self._build_wheel_tables()
+            cache.store(self, wheels)
+        self._compiled = self._build_tables(wheels)
+        return self 
+    
+    def _build_tables(self, wheels=None):
+        # wheels are the tables of _build_wheel_tables, if they were loaded 
+        parts = [self.reflector] + self.rotors
+        if self.etw is not None:
+            parts.append(self.etw)
+        for part in parts:
+            if part.in_map != ALPHABET:
+                raise RuntimeError("Cannot compile rotor with alphabet {0}".format(part.in_map))
+        
+        plug = [offset(self._plug(x)) for x in ALPHABET]
+        if self.etw is not None:
+            forward, backward = self.etw.tables()
+            etw_in = forward[self.etw.offset(0)]
+            etw_out = backward[self.etw.offset(0)]
+        else:
+            etw_in = etw_out = tuple(range(26))
+        
+        # Codes 26 to 51 enter the machine without passing the plugboard, see key_code
+        entry = tuple(etw_in[plug[x]] for x in range(26)) + etw_in
+        output = "".join(ALPHABET[plug[etw_out[x]]] for x in range(26))
+        if wheels is None:
+            wheels = self._build_wheel_tables()
+        return (entry, output) + tuple(wheels)
+    
+    def _build_wheel_tables(self):
+        # Tables of the rotors (right to left) and the reflector, which only 
+        # depend on their wiring, and the stepping of the rotors
+        rotors = list(reversed(self.rotors))
+        return (
+            tuple(rotor.tables()[0] for rotor in rotors),
+            tuple(rotor.tables()[1] for rotor in rotors),
+            self.reflector.tables()[0],
+            tuple(rotor.stepping for rotor in rotors))
+    
+    def _build_key_path(self):
+        # The compiled tables arranged for single key presses: rotor tables 
+        # indexed by rotation instead of offset, notches as rotations and the 
+        # reflector table for every reflector rotation, so push_key works on 
+        # the rotations directly. Kept with the tables and wheels it was made 
+        # from, set_ring or compile make it be rebuilt.
+        entry, output, forward, backward, reflector, stepping = self._compiled
+        rotors = list(reversed(self.rotors))
+        
+        def by_rotation(table, wheel):
+            return tuple(table[wheel.offset(rotation)] for rotation in range(26))
+        
+        return (self._compiled, self.rotors, self.reflector, entry, output, 
+            tuple(by_rotation(table, rotor) for table, rotor in zip(forward, rotors)), 
+            tuple(by_rotation(table, rotor) for table, rotor in zip(backward, rotors)), 
+            by_rotation(reflector, self.reflector), 
+            tuple(tuple((x + rotor.ring_setting) % 26 for x in rotor.notches()) for rotor in rotors), 
+            stepping)
+    
+    def _push_compiled(self, letter):
+        code = _byte_codes[ord(letter)] if ord(letter) < 256 else key_code(letter)
+        if code < 0:
+            return letter 
+        path = self._key_path 
+        if (path is None or path[0] is not self._compiled or path[1] is not self.rotors 
+                or path[2] is not self.reflector):
+            path = self._key_path = self._build_key_path()
+        compiled, rotors, reflector, entry, output, forward, backward, reflections, notches, stepping = path 
+        rotations = self.state.rotations 
+        last = len(rotations) - 1
+        
+        # Stepping as in step_offsets, right to left
+        carry = True 
+        for k in range(last+1):
+            rotation = rotations[last-k]
+            at_notch = rotation in notches[k]
+            if carry:
+                if stepping[k]:
+                    rotations[last-k] = (rotation+1) % 26
+                carry = at_notch
+            elif k == 1:
+                # Double-stepping of the middle rotor
+                if at_notch:
+                    rotations[last-k] = (rotation+1) % 26
+                carry = at_notch
+            else:
+                break 
+        
+        code = entry[code]
+        for k in range(last+1):
+            code = forward[k][rotations[last-k]][code]
+        code = reflections[self.state.reflector][code]
+        for k in range(last, -1, -1):
+            code = backward[k][rotations[last-k]][code]
+        return output[code]
+    
+    def tables(self):
+        # The integer tables the fast paths work on, as (entry, output, 
+        # forward, backward, reflector, stepping) with the rotors right to 
+        # left, see _build_tables. Built on first use, which fixes the 
+        # plugboard and ETW like compile does.
+        if self._compiled is None:
+            self._compiled = self._build_tables()
+        return self._compiled 
+    
+    def notches(self):
+        # Notches of the rotors as offsets, right to left, for step_offsets
+        return tuple(rotor.notches() for rotor in reversed(self.rotors))
+    
+    def get_offsets(self):
+        # Rotor offsets, rotations minus ring settings, right to left
+        return [rotor.offset(rotation) for rotor, rotation in 
+            zip(reversed(self.rotors), reversed(self.state.rotations))]
+    
+    def set_offsets(self, offsets):
+        rotations = self.state.rotations
+        for i, k in enumerate(offsets):
+            index = len(rotations)-1-i
+            rotations[index] = (k + self.rotors[index].ring_setting) % len(self.rotors[index].in_map)
+    
+    def _encode_compiled(self, text):
+        entry, output, forward, backward, reflector, stepping = self._compiled
+        offsets = self.get_offsets()
+        notches = self.notches()
+        reflection = reflector[self.reflector.offset(self.state.reflector)]
+        count = len(offsets)
+        result = []
+        codes = {}
+        
+        for letter in text:
+            code = codes.get(letter)
+            if code is None:
+                code = codes[letter] = key_code(letter)
+            if code < 0:
+                result.append(letter)
+                continue 
+            
+            step_offsets(offsets, notches, stepping)
+            
+            code = entry[code]
+            for i in range(count):
+                code = forward[i][offsets[i]][code]
+            code = reflection[code]
+            for i in range(count-1, -1, -1):
+                code = backward[i][offsets[i]][code]
+            result.append(output[code])
+        
+        self.set_offsets(offsets)
+        return "".join(result)
+    
+    def _encode_cached(self, text):
+        # Every rotor state is one integer key into the cache, whose value is 
+        # the substitution of the whole machine as a string indexed by key 
+        # code, so a hit is a single lookup. The rotor states come from 
+        # step_events like in encode_vectorized. The tables are built on 
+        # first use, which fixes the plugboard and ETW like compile does.
+        entry, output, forward, backward, reflector, stepping = self.tables()
+        offsets = self.get_offsets()
+        notches = self.notches()
+        reflection = reflector[self.reflector.offset(self.state.reflector)]
+        count = len(offsets)
+        cache = self.permutation_cache
+        # Offsets are rotations minus ring settings, which is all the 
+        # substitution depends on, together with the wheels, the reflector 
+        # rotation and the plugboard and ETW in entry and output
+        wiring = (tuple(rotor.out_map for rotor in self.rotors), self.reflector.out_map, 
+            self.reflector.offset(self.state.reflector), entry, output)
+        base = cache.base(wiring, 26**count)
+        
+        codes = {}
+        letters = []
+        for letter in text:
+            code = codes.get(letter)
+            if code is None:
+                code = codes[letter] = key_code(letter)
+            letters.append(code)
+        presses = len(letters) - letters.count(-1)
+        
+        right = offsets[0]
+        right_step = 1 if stepping[0] else 0
+        others = tuple(offsets[1:])
+        weights = [26**i for i in range(1, count)]
+        rest = base + sum(x*weight for x, weight in zip(others, weights))
+        events = step_events(offsets, notches, stepping, presses)
+        event, state = next(events, (presses, None))
+        get = cache.get 
+        result = []
+        key = 0
+        
+        for letter, code in zip(text, letters):
+            if code < 0:
+                result.append(letter)
+                continue 
+            
+            if key == event:
+                others = state 
+                rest = base + sum(x*weight for x, weight in zip(others, weights))
+                event, state = next(events, (presses, None))
+            key += 1
+            right += right_step 
+            if right == 26:
+                right = 0
+            
+            substitution = get(rest + right)
+            if substitution is None:
+                current = (right,) + others 
+                permutation = []
+                for x in range(26):
+                    for i in range(count):
+                        x = forward[i][current[i]][x]
+                    x = reflection[x]
+                    for i in range(count-1, -1, -1):
+                        x = backward[i][current[i]][x]
+                    permutation.append(x)
+                substitution = "".join(output[permutation[x]] for x in entry)
+                cache.put(rest + right, substitution)
+            
+            result.append(substitution[code])
+        
+        for event in events:
+            pass 
+        self.set_offsets(offsets)
+        return "".join(result)
+    
+    def seek(self, count):
+        # Moves the rotors forward as if count letters had been typed
+        notches = self.notches()
+        stepping = tuple(rotor.stepping for rotor in reversed(self.rotors))
+        self.set_offsets(offsets_after(self.get_offsets(), notches, stepping, count))
+    
+    def state_at(self, count):
+        # Rotor state as returned by get_rotor_state after count more letters
+        snapshot = self.snapshot()
+        self.seek(count)
+        state = self.get_rotor_state()
+        self.restore(snapshot)
+        return state 
+    
+    def period(self):
+        # Key presses before the rotor positions run into their cycle, and 
+        # the length of the cycle. Needs numpy.
+        notches = self.notches()
+        stepping = tuple(rotor.stepping for rotor in reversed(self.rotors))
+        tail, cycle, index = stepping_cycle(self.get_offsets(), notches, stepping)
+        return tail, cycle.shape[1]
+    
+    def state_cycle(self):
+        # Rotor positions of the whole cycle the machine runs into, starting 
+        # with the first one reached from the current position, as a uint8 
+        # array with one row per key press laid out like get_rotor_state. 
+        np = import_numpy()
+        notches = self.notches()
+        stepping = tuple(rotor.stepping for rotor in reversed(self.rotors))
+        tail, cycle, index = stepping_cycle(self.get_offsets(), notches, stepping)
+        
+        rings = np.array([rotor.ring_setting for rotor in self.rotors], dtype=np.intp)
+        rotations = (np.roll(cycle, -index, axis=1)[::-1].T + rings) % 26
+        if self.rotatable_reflector:
+            reflector = np.full((len(rotations), 1), self.state.reflector)
+            rotations = np.concatenate([reflector, rotations], axis=1)
+        return rotations.astype(np.uint8)
+    
+    def encode_batch(self, text, rotations):
+        # Encodes text once for every start position in rotations, which has 
+        # one row of rotor rotations (left to right) per start position. 
+        # Returns the output letters as indices, one row per start position, 
+        # leaving out characters that do not step the rotors. Needs numpy.
+        np = import_numpy()
+        entry, output, forward, backward, reflector, stepping = self.tables()
+        codes = [entry[x] for x in (key_code(letter) for letter in text) if x >= 0]
+        
+        rotations = np.asarray(rotations, dtype=np.intp).reshape(-1, len(self.rotors))
+        rings = np.array([rotor.ring_setting for rotor in reversed(self.rotors)], dtype=np.intp)
+        offsets = (rotations[:, ::-1].T - rings[:, None]) % 26
+        notches = [rotor.notches() for rotor in reversed(self.rotors)]
+        
+        forward = np.asarray(forward, dtype=np.intp)
+        backward = np.asarray(backward, dtype=np.intp)
+        reflection = np.asarray(reflector[self.reflector.offset(self.state.reflector)], dtype=np.intp)
+        output = np.array([offset(x) for x in output], dtype=np.uint8)
+        result = np.empty((len(rotations), len(codes)), dtype=np.uint8)
+        
+        for key, code in enumerate(codes):
+            step_offsets_array(offsets, notches, stepping)
+            letters = np.full(len(rotations), code, dtype=np.intp)
+            for i in range(len(offsets)):
+                letters = forward[i, offsets[i], letters]
+            letters = reflection[letters]
+            for i in range(len(offsets)-1, -1, -1):
+                letters = backward[i, offsets[i], letters]
+            result[:, key] = output[letters]
+        
+        return result 
+    
+    def permutation_batch(self, rotations, keys):
+        # Substitution of every letter at the given key presses (0 is the 
+        # first key press) from every start position in rotations, as an 
+        # array indexed by [start position, key press, letter]. Needs numpy.
+        np = import_numpy()
+        entry, output, forward, backward, reflector, stepping = self.tables()
+        keys = list(keys)
+        
+        rotations = np.asarray(rotations, dtype=np.intp).reshape(-1, len(self.rotors))
+        rings = np.array([rotor.ring_setting for rotor in reversed(self.rotors)], dtype=np.intp)
+        offsets = (rotations[:, ::-1].T - rings[:, None]) % 26
+        notches = [rotor.notches() for rotor in reversed(self.rotors)]
+        
+        forward = np.asarray(forward, dtype=np.intp)
+        backward = np.asarray(backward, dtype=np.intp)
+        reflection = np.asarray(reflector[self.reflector.offset(self.state.reflector)], dtype=np.intp)
+        entry = np.asarray(entry[:26], dtype=np.intp)
+        output = np.array([offset(x) for x in output], dtype=np.uint8)
+        result = np.empty((len(rotations), len(keys), 26), dtype=np.uint8)
+        wanted = dict((key, i) for i, key in enumerate(keys))
+        
+        for key in range(max(keys)+1 if keys else 0):
+            step_offsets_array(offsets, notches, stepping)
+            if key not in wanted:
+                continue 
+            
+            letters = np.broadcast_to(entry, (len(rotations), 26))
+            for i in range(len(offsets)):
+                letters = forward[i, offsets[i][:, None], letters]
+            letters = reflection[letters]
+            for i in range(len(offsets)-1, -1, -1):
+                letters = backward[i, offsets[i][:, None], letters]
+            result[:, wanted[key]] = output[letters]
+        
+        return result 
+    
+    def encode_vectorized(self, text):
+        # Same result as encode, but the rotor positions of all key presses 
+        # and the letters are computed as numpy arrays. Pays off for long texts.
+        np = import_numpy()
+        is_ascii = text.isascii()
+        if is_ascii:
+            data = np.frombuffer(text.encode("ascii"), dtype=np.uint8)
+            codes = np.array(_byte_codes, dtype=np.int8)[data]
+        else:
+            data = np.frombuffer(text.encode("utf-32-le"), dtype=np.uint32)
+            unique, inverse = np.unique(data, return_inverse=True)
+            codes = np.array([key_code(chr(x)) for x in unique], dtype=np.int8)[inverse]
+        
+        keys, letters = self._encode_codes(np, codes)
+        result = data.copy()
+        result[keys] = letters 
+        
+        if is_ascii:
+            return result.tobytes().decode("ascii")
+        else:
+            return result.tobytes().decode("utf-32-le")
+    
+    def _encode_codes(self, np, codes):
+        # Indices of the key presses among the key codes and their output 
+        # letters as ASCII codes, moving the rotors on 
+        entry, output, forward, backward, reflector, stepping = self.tables()
+        offsets = self.get_offsets()
+        notches = self.notches()
+        keys = np.flatnonzero(codes >= 0)
+        positions = offset_positions(offsets, notches, stepping, len(keys))
+        
+        forward = np.asarray(forward, dtype=np.intp)
+        backward = np.asarray(backward, dtype=np.intp)
+        letters = np.asarray(entry, dtype=np.intp)[codes[keys]]
+        for i in range(len(offsets)):
+            letters = forward[i, positions[i], letters]
+        letters = np.asarray(reflector[self.reflector.offset(self.state.reflector)], dtype=np.intp)[letters]
+        for i in range(len(offsets)-1, -1, -1):
+            letters = backward[i, positions[i], letters]
+        
+        self.set_offsets(offsets)
+        return keys, np.frombuffer(output.encode("ascii"), dtype=np.uint8)[letters]
+    
+    def encode_into(self, src, dst, vectorized=False):
+        # Encodes the bytes of src into dst, which can be the same buffer. 
+        # Bytes are read as Latin-1 characters, so ASCII text gets the same 
+        # result as encode, and every byte gives one output byte. Works on 
+        # anything with the buffer protocol, such as bytearray or mmap. With 
+        # vectorized the work is done by numpy, as in encode_vectorized. 
+        # Returns the number of bytes written.
+        with memoryview(src) as source, memoryview(dst) as target:
+            with source.cast("B") as source, target.cast("B") as target:
+                if len(target) < len(source):
+                    raise ValueError("Destination buffer is smaller than the source")
+                if vectorized:
+                    self._encode_into_vectorized(source, target)
+                else:
+                    self._encode_into(source, target)
+                return len(source)
+    
+    def _encode_into(self, source, target):
+        entry, output, forward, backward, reflector, stepping = self.tables()
+        offsets = self.get_offsets()
+        notches = self.notches()
+        reflection = reflector[self.reflector.offset(self.state.reflector)]
+        output = output.encode("ascii")
+        codes = _byte_codes 
+        count = len(offsets)
+        
+        for index, byte in enumerate(source):
+            code = codes[byte]
+            if code < 0:
+                target[index] = byte 
+                continue 
+            
+            step_offsets(offsets, notches, stepping)
+            
+            code = entry[code]
+            for i in range(count):
+                code = forward[i][offsets[i]][code]
+            code = reflection[code]
+            for i in range(count-1, -1, -1):
+                code = backward[i][offsets[i]][code]
+            target[index] = output[code]
+        
+        self.set_offsets(offsets)
+    
+    def _encode_into_vectorized(self, source, target):
+        np = import_numpy()
+        data = np.frombuffer(source, dtype=np.uint8)
+        result = np.frombuffer(target, dtype=np.uint8)[:len(data)]
+        keys, letters = self._encode_codes(np, np.array(_byte_codes, dtype=np.int8)[data])
+        if not np.may_share_memory(data, result):
+            result[:] = data 
+        result[keys] = letters 
     
     def _plug(self, letter):
         if letter in self.plugboard:
@@ -117,6 +1137,13 @@ class EnigmaMachine(object):
             return letter 
     
     def push_key(self, letter):
+        # A single key press goes through the tables even with a permutation 
+        # cache, filling in a whole permutation for one letter would cost more 
+        # than it saves
+        if (self._compiled is not None or self.permutation_cache is not None) and len(letter) == 1:
+            self.tables()
+            return self._push_compiled(letter)
+        
         if not letter.strip():
             return letter
         letter = letter.upper()
@@ -132,31 +1159,33 @@ class EnigmaMachine(object):
         
         if self.etw is not None:
             letter = self.etw.encode(letter)
-            
-        for i, rotor in enumerate(reversed(self.rotors)):
-            next_rotor_steps = rotor.turnover()
+        
+        rotations = self.state.rotations
+        for i, index in enumerate(reversed(range(len(self.rotors)))):
+            rotor = self.rotors[index]
+            next_rotor_steps = rotor.turnover(rotations[index])
             if curr_rotor_steps:
-                rotor.advance()
+                rotations[index] = rotor.advance(rotations[index])
                 curr_rotor_steps = next_rotor_steps
                 
             elif i == 1:
                 # Implement double-stepping for middle rotor 
                 if next_rotor_steps:
-                    rotor.advance()
+                    rotations[index] = rotor.advance(rotations[index])
                 curr_rotor_steps = next_rotor_steps
             else:
                 curr_rotor_steps = False
         
         # Encode letter
-        for rotor in reversed(self.rotors):
-            letter = rotor.encode(letter)
+        for index in reversed(range(len(self.rotors))):
+            letter = self.rotors[index].encode(letter, rotations[index])
         
         # Reflect letter 
-        letter = self.reflector.encode(letter)
+        letter = self.reflector.encode(letter, self.state.reflector)
             
         # Encode letter back 
-        for rotor in self.rotors:
-            letter = rotor.encode_back(letter)
+        for rotor, rotation in zip(self.rotors, rotations):
+            letter = rotor.encode_back(letter, rotation)
         
         if self.etw is not None:
             letter = self.etw.encode_back(letter)
@@ -168,6 +1197,11 @@ class EnigmaMachine(object):
         return letter 
     
     def encode(self, text):
+        if self.permutation_cache is not None:
+            return self._encode_cached(text)
+        if self._compiled is not None:
+            return self._encode_compiled(text)
+        
         result = StringIO()
         
         for letter in text:
@@ -175,35 +1209,172 @@ class EnigmaMachine(object):
         
         return result.getvalue()
     
+    def encode_parallel(self, text, workers=None):
+        # Splits the text into one piece per worker and encodes the pieces in 
+        # separate processes, each with a copy of the machine moved forward 
+        # to the key press the piece starts at.
+        if workers is None:
+            workers = os.cpu_count() or 1
+        size = -(-len(text) // workers)
+        if workers <= 1 or size == 0:
+            return self.encode(text)
+        
+        pieces = [text[i:i+size] for i in range(0, len(text), size)]
+        starts = []
+        count = 0
+        for piece in pieces:
+            starts.append(count)
+            # Whitespace is passed through without stepping the rotors
+            count += len(re.sub(r"\s", "", piece))
+        
+        # Imported here, it is the slowest import of this module and only 
+        # needed for parallel encoding
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(_encode_piece, [self]*len(pieces), starts, pieces))
+        
+        self.seek(count)
+        return "".join(results)
+    
     def set_ring(self, *args):
+        # Specs are immutable and may be shared with clones, so they are replaced 
+        rotors = list(self.rotors)
         if self.rotatable_reflector:
-            self.reflector.ring_setting = args[0]
+            self.reflector = self.reflector.with_ring(args[0])
             
             for i, val in enumerate(args[1:]):
-                self.rotors[i].ring_setting = val
+                rotors[i] = rotors[i].with_ring(val)
         else:
             for i, val in enumerate(args):
-                self.rotors[i].ring_setting = val
+                rotors[i] = rotors[i].with_ring(val)
+        self.rotors = rotors 
     
     def set_rotor_state(self, state):
         if not self.rotatable_reflector:
             assert len(state) == len(self.rotors)
                 
-            for i, rotor in enumerate(self.rotors):
-                rotor.rotation = offset(state[i])
+            for i in range(len(self.rotors)):
+                self.state.rotations[i] = offset(state[i])
 
         else:
             assert len(state) == len(self.rotors)+1
-            self.reflector.rotation = offset(state[0])
+            self.state.reflector = offset(state[0])
                 
-            for i, rotor in enumerate(self.rotors):
-                rotor.rotation = offset(state[i+1])
+            for i in range(len(self.rotors)):
+                self.state.rotations[i] = offset(state[i+1])
     
     def get_rotor_state(self):
         if not self.rotatable_reflector:
-            return "".join(ALPHABET[rotor.rotation] for rotor in self.rotors)
+            return "".join(ALPHABET[rotation] for rotation in self.state.rotations)
         else:
-            return ALPHABET[self.reflector.rotation] + "".join(ALPHABET[rotor.rotation] for rotor in self.rotors)
+            return ALPHABET[self.state.reflector] + "".join(ALPHABET[rotation] for rotation in self.state.rotations)
+    
+    def instrument(self, metrics=None, callback=None):
+        # Switches the machine to an encode that fills in metrics and calls 
+        # callback with a snapshot after every call. The class of the machine 
+        # is swapped, so a machine that is not instrumented pays nothing.
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.metrics_callback = callback 
+        self.__class__ = InstrumentedEnigmaMachine
+        return self.metrics 
+
+
+def _encode_piece(machine, start, text):
+    machine.seek(start)
+    return machine.encode(text)
+
+
+class InstrumentedEnigmaMachine(EnigmaMachine):
+    # Created by EnigmaMachine.instrument. Encodes with the compiled tables, 
+    # timing the stages of every key press. The plugboard stage includes 
+    # the ETW. The vectorized and batch methods are not instrumented.
+    def uninstrument(self):
+        self.__class__ = EnigmaMachine
+    
+    def push_key(self, letter):
+        return self.encode(letter)
+    
+    def encode_parallel(self, text, workers=None):
+        # Metrics collected in worker processes would be lost 
+        return self.encode(text)
+    
+    def encode_into(self, src, dst, vectorized=False):
+        with memoryview(src) as source:
+            result = self.encode(source.tobytes().decode("latin-1")).encode("latin-1")
+        with memoryview(dst) as target:
+            target.cast("B")[:len(result)] = result 
+        return len(result)
+    
+    def encode(self, text):
+        metrics = self.metrics 
+        entry, output, forward, backward, reflector, stepping = self.tables()
+        offsets = self.get_offsets()
+        notches = self.notches()
+        reflection = reflector[self.reflector.offset(self.state.reflector)]
+        count = len(offsets)
+        plugged = set(offset(x) for x in self.plugboard)
+        advances = [0]*count 
+        plugboard_time = stepping_time = forward_time = reflector_time = backward_time = 0.0
+        clock = perf_counter 
+        result = []
+        
+        for letter in text:
+            code = key_code(letter)
+            if code < 0:
+                result.append(letter)
+                continue 
+            metrics.keystrokes += 1
+            if code < 26 and letter.upper() != ALPHABET[code]:
+                metrics.substitutions += 1
+            
+            start = clock()
+            if code in plugged:
+                metrics.plugboard_hits += 1
+            code = entry[code]
+            
+            stepped = clock()
+            before = list(offsets)
+            step_offsets(offsets, notches, stepping)
+            for i in range(count):
+                if offsets[i] != before[i]:
+                    advances[i] += 1
+                    if i > 0 and before[i-1] in notches[i-1]:
+                        metrics.turnovers += 1
+                    elif i == 1:
+                        metrics.double_steps += 1
+            
+            forwarded = clock()
+            for i in range(count):
+                code = forward[i][offsets[i]][code]
+            reflected = clock()
+            code = reflection[code]
+            returned = clock()
+            for i in range(count-1, -1, -1):
+                code = backward[i][offsets[i]][code]
+            
+            plugging = clock()
+            letter = output[code]
+            if letter in self.plugboard:
+                metrics.plugboard_hits += 1
+            result.append(letter)
+            end = clock()
+            
+            plugboard_time += (stepped - start) + (end - plugging)
+            stepping_time += forwarded - stepped 
+            forward_time += reflected - forwarded 
+            reflector_time += returned - reflected 
+            backward_time += plugging - returned 
+        
+        self.set_offsets(offsets)
+        for i, steps in enumerate(advances):
+            index = count-1-i
+            metrics.advances[index] = metrics.advances.get(index, 0) + steps 
+        for stage, seconds in (("plugboard", plugboard_time), ("stepping", stepping_time), 
+                ("forward", forward_time), ("reflector", reflector_time), ("backward", backward_time)):
+            metrics.add_time(stage, seconds)
+        if self.metrics_callback is not None:
+            self.metrics_callback(metrics.snapshot())
+        return "".join(result)
 
 
 map = {"2": "XA",
@@ -226,13 +1397,84 @@ unescape = {"A": "2",
 
 
 
+# Codecs of ArbitraryDataEnigma. Version 1 is base32 with escape sequences, 
+# version 2 packs blocks of bytes into letters as base 26 numbers. The 
+# ciphertext does not say which codec made it: a version letter inside the 
+# encryption would show whether a key is right, so callers have to keep 
+# track of the codec and pass the same one for decoding.
+CODEC_BASE32 = 1
+CODEC_RADIX26 = 2
+
+RADIX26_BLOCK = 32 # bytes per block
+RADIX26_LETTERS = 55 # smallest n with 26**n >= 256**32
+RADIX26_TRAILER = 2 # letters giving the number of padding bytes in the last block
+
+
+def radix26_pack(block):
+    # 26**55 is about 5.7 times 256**32, so block values written as they 
+    # are would always start with A to E. Instead the letters are a random 
+    # number among those that radix26_unpack scales down to the block 
+    # value, which spreads the blocks over all letter sequences alike.
+    value = int.from_bytes(block, "big")
+    low = -(-value*26**RADIX26_LETTERS // 256**RADIX26_BLOCK)
+    high = -(-(value+1)*26**RADIX26_LETTERS // 256**RADIX26_BLOCK)
+    value = low + int(random()*(high - low))
+    letters = []
+    for i in range(RADIX26_LETTERS):
+        value, digit = divmod(value, 26)
+        letters.append(ALPHABET[digit])
+    return "".join(reversed(letters))
+
+
+def radix26_unpack(letters):
+    value = 0
+    for letter in letters:
+        value = value*26 + offset(letter)
+    # Any letters decode to a block, so a wrong key cannot be told from 
+    # values that are out of range.
+    return (value*256**RADIX26_BLOCK // 26**RADIX26_LETTERS).to_bytes(RADIX26_BLOCK, "big")
+
+
+def radix26_trailer(padding):
+    # Random number below 26**2 that is padding modulo the block size 
+    count = 26**RADIX26_TRAILER // RADIX26_BLOCK
+    value = padding + RADIX26_BLOCK*int(random()*count)
+    return ALPHABET[value // 26] + ALPHABET[value % 26]
+
+
+def radix26_padding(trailer):
+    return (offset(trailer[0])*26 + offset(trailer[1])) % RADIX26_BLOCK
+
+
+# Chi-squared value for 25 degrees of freedom at p = 0.001, above which the 
+# first letters of radix-26 blocks are taken as not uniform
+RADIX26_LEADER_LIMIT = 52.62
+
+
+def radix26_leaders(blocks, rng):
+    # Chi-squared statistic of the first letters of radix26_pack for blocks 
+    # random blocks from rng against the uniform distribution. Decrypting 
+    # with the right key gives these letters, so any skew would tell right 
+    # keys from wrong ones. Stays below RADIX26_LEADER_LIMIT for an even 
+    # spread.
+    counts = [0]*26
+    for i in range(blocks):
+        counts[offset(radix26_pack(rng.randbytes(RADIX26_BLOCK))[0])] += 1
+    expected = blocks / 26
+    return sum((x - expected)**2 / expected for x in counts)
+
+
 class ArbitraryDataEnigma(object):
-    def __init__(self, enigma):
+    # codec is CODEC_BASE32 or CODEC_RADIX26 and has to be the same for 
+    # encoding and decoding, see above
+    def __init__(self, enigma, codec=CODEC_BASE32):
+        if codec not in (CODEC_BASE32, CODEC_RADIX26):
+            raise RuntimeError("Unsupported codec: {0}".format(codec))
         self.enigma = enigma 
+        self.codec = codec 
     
-    def encode(self, data):
+    def _escape(self, b32result):
         newdata = StringIO()
-        b32result = base64.b32encode(data).decode("ascii")
             
         for symbol in b32result:
             if symbol in map:
@@ -247,14 +1489,11 @@ class ArbitraryDataEnigma(object):
                     newdata.write("X")
                 newdata.write(symbol)
                 
-        return self.enigma.encode(newdata.getvalue())
+        return newdata.getvalue()
     
-    def decode(self, data):
-        decodeddata = self.enigma.encode(data)
+    def _unescape(self, decodeddata, next_escape=False):
         newdata = StringIO()
         
-        next_escape = False 
-        
         for symbol in decodeddata:
             if not next_escape:
                 if symbol == "X":
@@ -266,51 +1505,209 @@ class ArbitraryDataEnigma(object):
                     symbol = unescape[symbol]
                 newdata.write(symbol)
                 next_escape = False 
-        if newdata.tell() % 8 != 0:
-            padding = 8 - newdata.tell() % 8
-            newdata.write("="*padding)
-        return base64.b32decode(newdata.getvalue())
+        return newdata.getvalue(), next_escape
+    
+    def _pack(self, data, final):
+        # Letters for whole blocks of data. The last block is padded with 
+        # random bytes and followed by the trailer if final is set.
+        padding = 0
+        if final:
+            padding = -len(data) % RADIX26_BLOCK
+            data += os.urandom(padding)
+        
+        newdata = StringIO()
+        for i in range(0, len(data), RADIX26_BLOCK):
+            newdata.write(radix26_pack(data[i:i+RADIX26_BLOCK]))
+        if final:
+            newdata.write(radix26_trailer(padding))
+        return newdata.getvalue()
+    
+    def _unpack(self, letters, trailer=None):
+        if len(letters) % RADIX26_LETTERS != 0:
+            raise ValueError("Radix-26 ciphertext has an invalid length")
+        
+        data = b"".join(radix26_unpack(letters[i:i+RADIX26_LETTERS]) 
+            for i in range(0, len(letters), RADIX26_LETTERS))
+        if trailer is not None:
+            data = data[:max(len(data) - radix26_padding(trailer), 0)]
+        return data 
+    
+    def encode(self, data):
+        if self.codec == CODEC_RADIX26:
+            return self.enigma.encode(self._pack(data, True))
+        
+        return self.enigma.encode(self._escape(self._b32encode(data)))
+    
+    def decode(self, data):
+        decodeddata = self.enigma.encode(data)
+        if self.codec == CODEC_RADIX26:
+            if len(decodeddata) < RADIX26_TRAILER:
+                raise ValueError("Radix-26 ciphertext has an invalid length")
+            return self._unpack(decodeddata[:-RADIX26_TRAILER], decodeddata[-RADIX26_TRAILER:])
+        
+        newdata = self._unescape(decodeddata)[0]
+        if len(newdata) % 8 != 0:
+            padding = 8 - len(newdata) % 8
+            newdata += "="*padding
+        return self._b32decode(newdata)
+    
+    def _b32encode(self, data):
+        return base64.b32encode(data).decode("ascii")
+    
+    def _b32decode(self, text):
+        return base64.b32decode(text)
+    
+    def encode_stream(self, src, dst, chunk_size=64*1024):
+        # Like encode, but reads bytes from src and writes the ciphertext as 
+        # ASCII bytes to dst in chunks. Chunks are whole base32 groups of 
+        # 5 bytes or whole radix-26 blocks, so padding only occurs at the 
+        # end and memory stays bounded.
+        group = RADIX26_BLOCK if self.codec == CODEC_RADIX26 else 5
+        chunk_size = max(chunk_size - chunk_size % group, group)
+        pending = b""
+        while True:
+            data = src.read(chunk_size)
+            if not data:
+                break 
+            data = pending + data 
+            cut = len(data) - len(data) % group
+            pending = data[cut:]
+            if cut:
+                dst.write(self._encode_chunk(data[:cut], False))
+        
+        if pending or self.codec == CODEC_RADIX26:
+            dst.write(self._encode_chunk(pending, True))
+    
+    def _encode_chunk(self, data, final):
+        if self.codec == CODEC_RADIX26:
+            newdata = self._pack(data, final)
+        else:
+            newdata = self._escape(self._b32encode(data))
+        return self.enigma.encode(newdata).encode("ascii")
+    
+    def decode_stream(self, src, dst, chunk_size=64*1024):
+        # Reverse of encode_stream. The escape state and any incomplete base32 
+        # group or radix-26 block are carried over to the next chunk.
+        next_escape = False 
+        pending = ""
+        while True:
+            data = src.read(chunk_size)
+            if not data:
+                break 
+            newdata = self.enigma.encode(data.decode("ascii"))
+            if self.codec == CODEC_RADIX26:
+                newdata = pending + newdata 
+                # Keep the last block and the trailer until the end 
+                keep = RADIX26_LETTERS + RADIX26_TRAILER
+                cut = max(len(newdata) - keep, 0)
+                cut -= cut % RADIX26_LETTERS
+                pending = newdata[cut:]
+                if cut:
+                    dst.write(self._unpack(newdata[:cut]))
+            else:
+                newdata, next_escape = self._unescape(newdata, next_escape)
+                newdata = pending + newdata 
+                cut = len(newdata) - len(newdata) % 8
+                pending = newdata[cut:]
+                if cut:
+                    dst.write(self._b32decode(newdata[:cut]))
+        
+        if self.codec == CODEC_RADIX26:
+            if len(pending) < RADIX26_TRAILER:
+                raise ValueError("Radix-26 ciphertext has an invalid length")
+            dst.write(self._unpack(pending[:-RADIX26_TRAILER], pending[-RADIX26_TRAILER:]))
+        elif pending:
+            pending += "="*(8 - len(pending) % 8)
+            dst.write(self._b32decode(pending))
+    
+    def instrument(self, metrics=None, callback=None):
+        # Like EnigmaMachine.instrument, times the codec stages. The machine 
+        # is instrumented as well and shares the metrics unless it already is.
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.metrics_callback = callback 
+        if not isinstance(self.enigma, InstrumentedEnigmaMachine):
+            self.enigma.instrument(self.metrics)
+        self.__class__ = InstrumentedArbitraryDataEnigma
+        return self.metrics 
+
+
+def _timed(stage, method):
+    def timed(self, *args):
+        start = perf_counter()
+        result = method(self, *args)
+        self.metrics.add_time(stage, perf_counter() - start)
+        return result 
+    return timed 
+
+
+def _reported(method):
+    def reported(self, *args, **kwargs):
+        result = method(self, *args, **kwargs)
+        if self.metrics_callback is not None:
+            self.metrics_callback(self.metrics.snapshot())
+        return result 
+    return reported 
+
+
+class InstrumentedArbitraryDataEnigma(ArbitraryDataEnigma):
+    # Created by ArbitraryDataEnigma.instrument
+    def uninstrument(self):
+        self.__class__ = ArbitraryDataEnigma
+        if isinstance(self.enigma, InstrumentedEnigmaMachine):
+            self.enigma.uninstrument()
+    
+    _escape = _timed("escape", ArbitraryDataEnigma._escape)
+    _unescape = _timed("escape", ArbitraryDataEnigma._unescape)
+    _b32encode = _timed("base32", ArbitraryDataEnigma._b32encode)
+    _b32decode = _timed("base32", ArbitraryDataEnigma._b32decode)
+    _pack = _timed("radix26", ArbitraryDataEnigma._pack)
+    _unpack = _timed("radix26", ArbitraryDataEnigma._unpack)
+    
+    encode = _reported(ArbitraryDataEnigma.encode)
+    decode = _reported(ArbitraryDataEnigma.decode)
+    encode_stream = _reported(ArbitraryDataEnigma.encode_stream)
+    decode_stream = _reported(ArbitraryDataEnigma.decode_stream)
 
 
 def rotor(num, off=offset("A")):
     if num == 1:
-        return RotorPiece(ALPHABET, "EKMFLGDQVZNTOWYHXUSPAIBRCJ", off, offset("Q"))
+        return RotorSpec(ALPHABET, "EKMFLGDQVZNTOWYHXUSPAIBRCJ", off, offset("Q"))
     elif num == 2:
-        return RotorPiece(ALPHABET, "AJDKSIRUXBLHWTMCQGZNPYFVOE", off, offset("E"))
+        return RotorSpec(ALPHABET, "AJDKSIRUXBLHWTMCQGZNPYFVOE", off, offset("E"))
     elif num == 3: 
-        return RotorPiece(ALPHABET, "BDFHJLCPRTXVZNYEIWGAKMUSQO", off, offset("V"))
+        return RotorSpec(ALPHABET, "BDFHJLCPRTXVZNYEIWGAKMUSQO", off, offset("V"))
     elif num == 4:
-        return RotorPiece(ALPHABET, "ESOVPZJAYQUIRHXLNFTGKDCMWB", off, offset("J"))
+        return RotorSpec(ALPHABET, "ESOVPZJAYQUIRHXLNFTGKDCMWB", off, offset("J"))
     elif num == 5:
-        return RotorPiece(ALPHABET, "VZBRGITYUPSDNHLXAWMJQOFECK", off, offset("Z"))
+        return RotorSpec(ALPHABET, "VZBRGITYUPSDNHLXAWMJQOFECK", off, offset("Z"))
     elif num == 6:
-        return RotorPiece(ALPHABET, "JPGVOUMFYQBENHZRDKASXLICTW", off, offset("Z"), offset("M"))
+        return RotorSpec(ALPHABET, "JPGVOUMFYQBENHZRDKASXLICTW", off, offset("Z"), offset("M"))
     elif num == 7:
-        return RotorPiece(ALPHABET, "NZJHGRCXMYSWBOUFAIVLPEKQDT", off, offset("Z"), offset("M"))
+        return RotorSpec(ALPHABET, "NZJHGRCXMYSWBOUFAIVLPEKQDT", off, offset("Z"), offset("M"))
     elif num == 8:
-        return RotorPiece(ALPHABET, "FKQHTLXOCBJSPDZRAMEWNIUYGV", off, offset("Z"), offset("M"))
+        return RotorSpec(ALPHABET, "FKQHTLXOCBJSPDZRAMEWNIUYGV", off, offset("Z"), offset("M"))
     else:
         raise RuntimeError("Unsupported rotor: {0}".format(num))
 
-refa = Reflector(ALPHABET, "EJMZALYXVBWFCRQUONTSPIKHGD") # A retail enigma rotor?
-refb = Reflector(ALPHABET, "YRUHQSLDPXNGOKMIEBFZCWVJAT")
-refc = Reflector(ALPHABET, "FVPJIAOYEDRZXWGCTKUQSBNMHL")
+refa = RotorSpec(ALPHABET, "EJMZALYXVBWFCRQUONTSPIKHGD") # A retail enigma rotor?
+refb = RotorSpec(ALPHABET, "YRUHQSLDPXNGOKMIEBFZCWVJAT")
+refc = RotorSpec(ALPHABET, "FVPJIAOYEDRZXWGCTKUQSBNMHL")
 
-refbthin = Reflector(ALPHABET, "ENKQAUYWJICOPBLMDXZVFTHRGS")
-refcthin = Reflector(ALPHABET, "RDOBJNTKVEHMLFCWZAXGYIPSUQ")
+refbthin = RotorSpec(ALPHABET, "ENKQAUYWJICOPBLMDXZVFTHRGS")
+refcthin = RotorSpec(ALPHABET, "RDOBJNTKVEHMLFCWZAXGYIPSUQ")
 
-beta = NonRotatableRotor(ALPHABET, "LEYJVCNIXWPBQMDRTAKZGFUHOS", offset("A"), None)
-gamma = NonRotatableRotor(ALPHABET, "FSOKANUERHMBTIYCWLQPZXVGJD", offset("A"), None)
+beta = RotorSpec(ALPHABET, "LEYJVCNIXWPBQMDRTAKZGFUHOS", offset("A"), stepping=False)
+gamma = RotorSpec(ALPHABET, "FSOKANUERHMBTIYCWLQPZXVGJD", offset("A"), stepping=False)
 
-etw_army = Stator(ALPHABET, ALPHABET)
-etw_commercial = Stator(ALPHABET, "QWERTZUIOASDFGHJKPYXCVBNML")
-etw_tirpitz =  Stator(ALPHABET, "KZROUQHYAIGBLWVSTDXFPNMCJE")
+etw_army = RotorSpec(ALPHABET, ALPHABET, stepping=False)
+etw_commercial = RotorSpec(ALPHABET, "QWERTZUIOASDFGHJKPYXCVBNML", stepping=False)
+etw_tirpitz =  RotorSpec(ALPHABET, "KZROUQHYAIGBLWVSTDXFPNMCJE", stepping=False)
 
 #railway enigma k 
-refrail = Reflector(ALPHABET, "QYHOGNECVPUZTFDJAXWMKISRBL")
-rotorrailI = RotorPiece(ALPHABET, "JGDQOXUSCAMIFRVTPNEWKBLZYH", 0, offset("N"))
-rotorrailII = RotorPiece(ALPHABET, "NTZPSFBOKMWRCJDIVLAEYUXHGQ", 0, offset("E"))
-rotorrailIII = RotorPiece(ALPHABET, "JVIUBHTCDYAKEQZPOSGXNRMWFL", 0, offset("Y"))
+refrail = RotorSpec(ALPHABET, "QYHOGNECVPUZTFDJAXWMKISRBL")
+rotorrailI = RotorSpec(ALPHABET, "JGDQOXUSCAMIFRVTPNEWKBLZYH", 0, offset("N"))
+rotorrailII = RotorSpec(ALPHABET, "NTZPSFBOKMWRCJDIVLAEYUXHGQ", 0, offset("E"))
+rotorrailIII = RotorSpec(ALPHABET, "JVIUBHTCDYAKEQZPOSGXNRMWFL", 0, offset("Y"))
         
 if __name__ == "__main__":
 
@@ -0,0 +1,221 @@
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+from random import Random
+
+from enigma import *
+
+
+SHORT_TEXT = "RQPS OCM MGPGEH LOW WXJPZSQ GZ JFHZIUZK"
+
+
+def make_m3():
+    machine = EnigmaMachine(refb, [rotor(II), rotor(IV), rotor(V)], etw_army, plugboard=[
+        "AV", "BS", "CG", "DL", "FU", "HZ", "IN", "KM", "OW", "RX"])
+    machine.set_ring(2-1, 21-1, 12-1)
+    machine.set_rotor_state("BLA")
+    return machine
+
+
+def make_m4():
+    machine = EnigmaMachine(refcthin, [beta, rotor(V), rotor(VI), rotor(VIII)], etw_army, plugboard=[
+        "AE", "BF", "CM", "DQ", "HU", "JN", "LX", "PR", "SZ", "VW"])
+    machine.set_ring(*offsets("EPEL"))
+    machine.set_rotor_state("CDSZ")
+    return machine
+
+
+def make_railway():
+    machine = EnigmaMachine(refrail, [rotorrailIII, rotorrailI, rotorrailII],
+                            RotorSpec(ALPHABET, "JWULCMNOHPQZYXIRADKEGVBTSF", stepping=False),
+                            rotatable_reflector=True)
+    machine.set_ring(26-1, 17-1, 16-1, 13-1)
+    machine.set_rotor_state("JEZA")
+    return machine
+
+
+def make_commercial():
+    machine = EnigmaMachine(refa, [rotor(II), rotor(I), rotor(III)], etw_commercial)
+    machine.set_ring(24-1, 13-1, 22-1)
+    machine.set_rotor_state("TFC")
+    return machine
+
+
+MODELS = [("m3", make_m3), ("m4", make_m4), ("railway", make_railway), ("commercial", make_commercial)]
+
+
+def engines():
+    result = [("reference", lambda machine: machine, "encode"),
+              ("compiled", lambda machine: machine.compile(), "encode")]
+    try:
+        import_numpy()
+    except RuntimeError:
+        pass
+    else:
+        result.append(("vectorized", lambda machine: machine, "encode_vectorized"))
+    return result
+
+
+def random_text(rng, length):
+    letters = ALPHABET + " "
+    return "".join(rng.choice(letters) for i in range(length))
+
+
+def percentiles(samples, points=(50, 90, 99)):
+    samples = sorted(samples)
+    return dict(("p{0}".format(p), samples[min(len(samples)-1, len(samples)*p // 100)]) for p in points)
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - start
+
+
+def peak_memory(function, *args):
+    # Tracing slows down allocations, so this is a separate run from the timed one
+    tracemalloc.start()
+    function(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+def bench_short(model, factory, engine, setup, method, repeat):
+    machine = setup(factory())
+    encode = getattr(machine, method)
+    keys = len(SHORT_TEXT.replace(" ", ""))
+    samples = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        encode(SHORT_TEXT)
+        samples.append((time.perf_counter() - start)*1e6)
+
+    result = {"name": "encode_short", "model": model, "engine": engine, "length": len(SHORT_TEXT),
+              "keys_per_second": keys*repeat / (sum(samples)/1e6)}
+    result.update(("latency_us_" + key, value) for key, value in percentiles(samples).items())
+    return result
+
+
+def bench_long(model, factory, engine, setup, method, length, rng):
+    text = random_text(rng, length)
+    keys = len(text.replace(" ", ""))
+    elapsed = timed(getattr(setup(factory()), method), text)
+    peak = peak_memory(getattr(setup(factory()), method), text)
+    return {"name": "encode_long", "model": model, "engine": engine, "length": length,
+            "keys_per_second": keys/elapsed, "seconds": elapsed, "peak_bytes": peak}
+
+
+def bench_data(size, rng, compiled):
+    data = rng.randbytes(size)
+    machine = make_m3()
+    if compiled:
+        machine.compile()
+    codec = ArbitraryDataEnigma(machine)
+    start = machine.snapshot()
+
+    def encode():
+        machine.restore(start)
+        return codec.encode(data)
+
+    def decode():
+        machine.restore(start)
+        return codec.decode(ciphertext)
+
+    ciphertext = encode()
+    encode_time, encode_peak = timed(encode), peak_memory(encode)
+    decode_time, decode_peak = timed(decode), peak_memory(decode)
+    return {"name": "arbitrary_data", "engine": "compiled" if compiled else "reference", "size": size,
+            "encode_bytes_per_second": size/encode_time, "decode_bytes_per_second": size/decode_time,
+            "encode_peak_bytes": encode_peak, "decode_peak_bytes": decode_peak,
+            "expansion": len(ciphertext)/float(size)}
+
+
+def run(long_length=100000, data_sizes=(1024, 1024*1024), repeat=200, seed=0, log=None):
+    rng = Random(seed)
+    results = []
+    for model, factory in MODELS:
+        for engine, setup, method in engines():
+            for result in (bench_short(model, factory, engine, setup, method, repeat),
+                           bench_long(model, factory, engine, setup, method, long_length, rng)):
+                results.append(result)
+                if log is not None:
+                    log(result)
+
+    for size in data_sizes:
+        for compiled in (False, True):
+            result = bench_data(size, rng, compiled)
+            results.append(result)
+            if log is not None:
+                log(result)
+
+    return {"python": platform.python_version(), "platform": platform.platform(),
+            "time": time.time(), "results": results}
+
+
+def result_key(result):
+    return (result["name"], result.get("model"), result["engine"], result.get("length", result.get("size")))
+
+
+def compare(current, baseline, tolerance=0.1):
+    # Throughput figures that dropped by more than tolerance against the baseline run
+    previous = dict((result_key(x), x) for x in baseline["results"])
+    regressions = []
+    for result in current["results"]:
+        old = previous.get(result_key(result))
+        if old is None:
+            continue
+        for field, value in result.items():
+            if field.endswith("per_second") and field in old and value < old[field]*(1-tolerance):
+                regressions.append((result_key(result), field, old[field], value))
+    return regressions
+
+
+def parse_size(text):
+    units = {"K": 1024, "M": 1024**2, "G": 1024**3}
+    text = text.upper().rstrip("B")
+    if text and text[-1] in units:
+        return int(float(text[:-1])*units[text[-1]])
+    return int(text)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Throughput benchmarks for the Enigma machines")
+    parser.add_argument("--long-length", type=int, default=100000, help="length of the long text")
+    parser.add_argument("--data-sizes", default="1K,1M",
+                        help="comma separated input sizes for ArbitraryDataEnigma, e.g. 1K,1M,100M")
+    parser.add_argument("--repeat", type=int, default=200, help="runs of the short text for latencies")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--compare", help="JSON file of an earlier run to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="allowed throughput drop, 0.1 is 10%%")
+    args = parser.parse_args(argv)
+
+    def log(result):
+        print(json.dumps(result), file=sys.stderr)
+
+    report = run(args.long_length, [parse_size(x) for x in args.data_sizes.split(",")],
+                 args.repeat, args.seed, log)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.tolerance)
+        for key, field, old, new in regressions:
+            print("Regression in {0} {1}: {2:.0f} -> {3:.0f}".format(key, field, old, new), file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,187 @@
+from collections import namedtuple
+
+from enigma import *
+from enigma_keysearch import REFLECTORS, run_jobs, start_positions, wheel_order_jobs
+
+
+Stop = namedtuple("Stop", ["reflector", "wheel_order", "rings", "rotor_state", "plugboard"])
+
+
+def letters_only(text):
+    return "".join(letter for letter in text.upper() if letter in ALPHABET)
+
+
+def build_menu(crib, ciphertext, position=0):
+    # Letter pairs of the crib and the ciphertext under it. Every edge is
+    # stored for both letters as (other letter, crib index).
+    menu = {}
+    for i, (plain, cipher) in enumerate(zip(crib, ciphertext[position:])):
+        if plain == cipher:
+            raise ValueError("Crib does not fit at position {0}, {1} would encrypt to itself".format(position, plain))
+        a, b = offset(plain), offset(cipher)
+        menu.setdefault(a, []).append((b, i))
+        menu.setdefault(b, []).append((a, i))
+    return menu
+
+
+def find_loops(menu):
+    # One loop for every edge that is not part of a spanning tree of the menu.
+    # A loop is a list of (letter, crib index, next letter) steps that ends at
+    # the letter it starts with.
+    parent = {}
+    loops = []
+    seen_edges = set()
+    for root in menu:
+        if root in parent:
+            continue
+        parent[root] = None
+        queue = [root]
+        while queue:
+            letter = queue.pop(0)
+            for other, i in menu[letter]:
+                if i in seen_edges:
+                    continue
+                seen_edges.add(i)
+                if other not in parent:
+                    parent[other] = (letter, i)
+                    queue.append(other)
+                else:
+                    loops.append(_close_loop(parent, letter, other, i))
+    return loops
+
+
+def _close_loop(parent, a, b, edge):
+    def path_to_root(letter):
+        path = [letter]
+        while parent[letter] is not None:
+            letter = parent[letter][0]
+            path.append(letter)
+        return path
+
+    path_a = path_to_root(a)
+    path_b = path_to_root(b)
+    common = next(x for x in path_a if x in path_b)
+
+    # common -> ... -> a, the edge to b, then b -> ... -> common
+    steps = []
+    letter = a
+    while letter != common:
+        up, i = parent[letter]
+        steps.insert(0, (up, i, letter))
+        letter = up
+    steps.append((a, edge, b))
+    letter = b
+    while letter != common:
+        up, i = parent[letter]
+        steps.append((letter, i, up))
+        letter = up
+    return steps
+
+
+def _rotate_loop(loop, letter):
+    for i, step in enumerate(loop):
+        if step[0] == letter:
+            return loop[i:] + loop[:i]
+    return None
+
+
+def loop_masks(np, loop, perms):
+    # Bitmask of the letters the start letter of the loop can be steckered
+    # to, for every start position at once. Such a letter has to be a fixed
+    # point of the product of the scrambler permutations around the loop.
+    identity = np.arange(26)
+    current = np.broadcast_to(identity, (perms.shape[0], 26))
+    for letter, i, following in loop:
+        current = np.take_along_axis(perms[:, i, :].astype(np.intp), current, axis=1)
+    fixed = current == identity
+    return (fixed * (1 << identity)).sum(axis=1)
+
+
+def propagate(menu, perm, test, hypothesis):
+    # Spreads the stecker hypothesis for the test letter through the menu and
+    # the diagonal board. Returns the stecker partner of every reached letter,
+    # or None as soon as some letter would need two partners.
+    partner = [-1]*26
+    queue = [(test, hypothesis)]
+    while queue:
+        letter, value = queue.pop()
+        if partner[letter] == value:
+            continue
+        if partner[letter] != -1:
+            return None
+        partner[letter] = value
+        # Diagonal board
+        queue.append((value, letter))
+        for other, i in menu.get(letter, ()):
+            queue.append((other, perm[i][value]))
+    return partner
+
+
+def run_wheel_order(ciphertext, crib, position, reflector, wheel_order, rings=(0, 0, 0), etw=etw_army,
+                    batch_size=4096):
+    # Tests all start positions of one wheel order and returns the consistent
+    # stops as (rotor state, plugboard pairs).
+    np = import_numpy()
+    ciphertext = letters_only(ciphertext)
+    crib = letters_only(crib)
+    menu = build_menu(crib, ciphertext, position)
+    loops = find_loops(menu)
+
+    # The test letter is the most connected letter of the menu
+    test = max(menu, key=lambda x: len(menu[x]))
+    test_loops = [loop for loop in (_rotate_loop(loop, test) for loop in loops) if loop is not None]
+    other_loops = [loop for loop in loops if _rotate_loop(loop, test) is None]
+
+    machine = EnigmaMachine(reflector, [rotor(x) for x in wheel_order], etw)
+    machine.set_ring(*rings)
+    machine.compile()
+
+    slots = len(wheel_order)
+    keys = range(position, position+len(crib))
+    stops = []
+    for index, rotations in start_positions(slots, batch_size):
+        perms = machine.permutation_batch(rotations, keys)
+
+        candidates = np.full(len(index), (1 << 26) - 1, dtype=np.int64)
+        for loop in test_loops:
+            candidates &= loop_masks(np, loop, perms)
+        for loop in other_loops:
+            candidates[loop_masks(np, loop, perms) == 0] = 0
+
+        for row in np.flatnonzero(candidates):
+            perm = perms[row].tolist()
+            mask = int(candidates[row])
+            for hypothesis in range(26):
+                if not mask & (1 << hypothesis):
+                    continue
+                partner = propagate(menu, perm, test, hypothesis)
+                if partner is None:
+                    continue
+                pairs = sorted(ALPHABET[a] + ALPHABET[b] for a, b in enumerate(partner) if a < b)
+                state = "".join(ALPHABET[x] for x in rotations[row])
+                stops.append((state, pairs))
+    return stops
+
+
+def bombe(ciphertext, crib, position=0, reflectors=REFLECTORS, rotors=(I, II, III, IV, V), rings=(0, 0, 0),
+          etw=etw_army, workers=None, progress=None, batch_size=4096):
+    # Crib attack over all reflectors, wheel orders and start positions.
+    # position is the index of the crib among the letters of the ciphertext.
+    jobs = wheel_order_jobs(reflectors, rotors, len(rings))
+    stops = []
+    done = 0
+
+    def collect(name, order, results):
+        for state, pairs in results:
+            stops.append(Stop(name, order, tuple(rings), state, pairs))
+        if progress is not None:
+            progress(done, len(jobs), len(stops))
+
+    arguments = [(ciphertext, crib, position, reflector, order, rings, etw, batch_size)
+                 for name, reflector, order in jobs]
+    for number, results in run_jobs(run_wheel_order, arguments, workers):
+        name, reflector, order = jobs[number]
+        done += 1
+        collect(name, order, results)
+
+    return stops
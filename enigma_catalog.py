@@ -0,0 +1,216 @@
+import json
+import os
+import sys
+from collections import namedtuple
+
+from enigma import *
+from enigma_keysearch import REFLECTORS, run_jobs, start_positions, wheel_order_jobs
+
+
+Setting = namedtuple("Setting", ["reflector", "wheel_order", "rings", "rotor_state"])
+
+
+def partitions(n, largest=None):
+    # Partitions of n as tuples in descending order
+    if largest is None:
+        largest = n
+    if n == 0:
+        return [()]
+    result = []
+    for first in range(min(n, largest), 0, -1):
+        for rest in partitions(n - first, first):
+            result.append((first,) + rest)
+    return result
+
+
+# The products AD, BE and CF of two self-inverse permutations without fixed
+# points have their cycles in pairs of equal length, so the cycle structure
+# of each is a partition of 13. A signature combines the indices of the
+# three partitions into one number.
+PARTITIONS = partitions(13)
+
+
+def _partition_codes(np):
+    # Pair counts per cycle length 1 to 13 read as a base 14 number, sorted
+    # together with the index of the partition they belong to
+    codes = []
+    for i, partition in enumerate(PARTITIONS):
+        codes.append((sum(14**(length-1) for length in partition), i))
+    codes.sort()
+    return np.array([x[0] for x in codes], dtype=np.int64), np.array([x[1] for x in codes], dtype=np.intp)
+
+
+def cycle_lengths(np, perms):
+    # Length of the cycle every letter is on, for permutations given as rows
+    perms = np.asarray(perms, dtype=np.intp)
+    identity = np.arange(perms.shape[-1])
+    lengths = np.zeros(perms.shape, dtype=np.intp)
+    current = np.broadcast_to(identity, perms.shape)
+    for k in range(1, perms.shape[-1]+1):
+        current = np.take_along_axis(perms, current, axis=-1)
+        lengths[(current == identity) & (lengths == 0)] = k
+    return lengths
+
+
+def partition_indices(np, perms):
+    # Index into PARTITIONS of the cycle structure of every permutation
+    lengths = cycle_lengths(np, perms)
+    # A cycle of length L has L letters, and cycles come in pairs
+    pairs = np.stack([(lengths == length).sum(axis=-1) // (2*length) for length in range(1, 14)], axis=-1)
+    codes = (pairs * 14**np.arange(13, dtype=np.int64)).sum(axis=-1)
+    known, indices = _partition_codes(np)
+    position = np.minimum(np.searchsorted(known, codes), len(known)-1)
+    if (known[position] != codes).any():
+        raise ValueError("Permutation does not have its cycles in pairs")
+    return indices[position]
+
+
+def combine(ad, be, cf):
+    count = len(PARTITIONS)
+    return (ad*count + be)*count + cf
+
+
+def wheel_order_signatures(reflector, wheel_order, rings=(0, 0, 0), etw=etw_army, batch_size=4096):
+    # Signature of every start position of one wheel order, with the start
+    # positions numbered as base 26 numbers of the rotations, left to right
+    np = import_numpy()
+    machine = EnigmaMachine(reflector, [rotor(x) for x in wheel_order], etw)
+    machine.set_ring(*rings)
+    machine.compile()
+
+    slots = len(wheel_order)
+    result = np.empty(26**slots, dtype=np.uint32)
+    for index, rotations in start_positions(slots, batch_size):
+        perms = machine.permutation_batch(rotations, range(6)).astype(np.intp)
+        products = [np.take_along_axis(perms[:, i+3], perms[:, i], axis=1) for i in range(3)]
+        result[index] = combine(*(partition_indices(np, x) for x in products))
+    return result
+
+
+def _save(np, path, array):
+    # Written under a temporary name, so an interrupted build leaves no partial file
+    with open(path + ".tmp", "wb") as f:
+        np.save(f, array)
+    os.replace(path + ".tmp", path)
+
+
+def _build_job(directory, number, reflector, wheel_order, rings, etw, batch_size):
+    np = import_numpy()
+    signatures = wheel_order_signatures(reflector, wheel_order, rings, etw, batch_size)
+    _save(np, os.path.join(directory, "order-{0}.npy".format(number)), signatures)
+    return number
+
+
+def build_catalog(directory, reflectors=REFLECTORS, rotors=(I, II, III, IV, V), rings=(0, 0, 0),
+                  etw=etw_army, workers=None, progress=None, batch_size=4096):
+    # Computes the signatures of all reflectors, wheel orders and start
+    # positions in worker processes and writes the index to directory. Wheel
+    # orders already computed by an earlier, interrupted build are skipped.
+    # progress is called with (done, total) after every wheel order.
+    np = import_numpy()
+    os.makedirs(directory, exist_ok=True)
+    jobs = wheel_order_jobs(reflectors, rotors, len(rings))
+    metadata = {"rings": list(rings), "slots": len(rings),
+                "jobs": [[name, list(order)] for name, reflector, order in jobs]}
+
+    metadata_path = os.path.join(directory, "catalog.json")
+    if os.path.exists(metadata_path):
+        with open(metadata_path) as f:
+            if json.load(f) != metadata:
+                raise RuntimeError("{0} holds a catalog with different settings".format(directory))
+    else:
+        with open(metadata_path, "w") as f:
+            json.dump(metadata, f)
+
+    pending = [number for number in range(len(jobs))
+               if not os.path.exists(os.path.join(directory, "order-{0}.npy".format(number)))]
+    done = len(jobs) - len(pending)
+    if progress is not None:
+        progress(done, len(jobs))
+
+    arguments = [(directory, number, jobs[number][1], jobs[number][2], rings, etw, batch_size)
+                 for number in pending]
+    for number, result in run_jobs(_build_job, arguments, workers):
+        done += 1
+        if progress is not None:
+            progress(done, len(jobs))
+
+    # The index is the signatures of all start positions sorted, next to the
+    # job number and start position each of them belongs to
+    signatures = np.concatenate([np.load(os.path.join(directory, "order-{0}.npy".format(number)))
+                                 for number in range(len(jobs))])
+    order = np.argsort(signatures, kind="stable")
+    _save(np, os.path.join(directory, "signatures.npy"), signatures[order])
+    _save(np, os.path.join(directory, "entries.npy"), order.astype(np.uint32))
+    return Catalog(directory)
+
+
+def indicator_permutations(indicators):
+    # The products AD, BE and CF from doubled message indicators, as lists
+    # mapping letter indices. The plugboard does not change their cycle
+    # structure, so they can be matched against the catalog directly.
+    products = [[-1]*26 for i in range(3)]
+    for indicator in indicators:
+        indicator = "".join(x for x in indicator.upper() if x in ALPHABET)
+        if len(indicator) != 6:
+            raise ValueError("Indicator {0} does not have 6 letters".format(indicator))
+        for i in range(3):
+            a, b = offset(indicator[i]), offset(indicator[i+3])
+            if products[i][a] not in (-1, b):
+                raise ValueError("Indicators contradict each other at {0}".format(indicator))
+            products[i][a] = b
+
+    for i, product in enumerate(products):
+        if -1 in product:
+            missing = "".join(ALPHABET[x] for x in range(26) if product[x] == -1)
+            raise ValueError("Indicators do not determine {0} for {1}".format(["AD", "BE", "CF"][i], missing))
+    return products
+
+
+class Catalog(object):
+    # Memory-mapped index written by build_catalog
+    def __init__(self, directory):
+        np = import_numpy()
+        with open(os.path.join(directory, "catalog.json")) as f:
+            metadata = json.load(f)
+        self.rings = tuple(metadata["rings"])
+        self.slots = metadata["slots"]
+        self.jobs = [(name, tuple(order)) for name, order in metadata["jobs"]]
+        self.signatures = np.load(os.path.join(directory, "signatures.npy"), mmap_mode="r")
+        self.entries = np.load(os.path.join(directory, "entries.npy"), mmap_mode="r")
+
+    def __len__(self):
+        return len(self.signatures)
+
+    def lookup(self, signature):
+        # Settings whose AD, BE and CF have the given combined signature
+        np = import_numpy()
+        begin = np.searchsorted(self.signatures, signature, side="left")
+        end = np.searchsorted(self.signatures, signature, side="right")
+        positions = 26**self.slots
+        result = []
+        for entry in self.entries[begin:end].tolist():
+            number, position = divmod(entry, positions)
+            name, order = self.jobs[number]
+            state = "".join(ALPHABET[(position // 26**(self.slots-1-i)) % 26] for i in range(self.slots))
+            result.append(Setting(name, order, self.rings, state))
+        return result
+
+    def lookup_indicators(self, indicators):
+        np = import_numpy()
+        products = indicator_permutations(indicators)
+        return self.lookup(combine(*(int(x) for x in partition_indices(np, products))))
+
+
+if __name__ == "__main__":
+    # enigma_catalog.py build DIRECTORY, or enigma_catalog.py lookup DIRECTORY
+    # with the indicators of a day on stdin
+    command, directory = sys.argv[1:3]
+    if command == "build":
+        def report(done, total):
+            print("{0}/{1} wheel orders".format(done, total), file=sys.stderr)
+
+        build_catalog(directory, progress=report)
+    else:
+        for setting in Catalog(directory).lookup_indicators(sys.stdin.read().split()):
+            print(setting)
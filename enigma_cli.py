@@ -1,3 +1,8 @@
+import argparse
+import io
+import os
+import sys
+
 from enigma import *
 
 
@@ -22,19 +27,79 @@ def ask_input(text, maxcount):
     return value 
     
     
+# Registry of the wheels by kind and name. Values are rotor numbers, names 
+# of wheels in the enigma module or the wiring of a stator, and the wheels 
+# are only looked up or built when first used.
+WHEELS = {
+    "reflector": {"A": "refa", "B": "refb", "C": "refc", "B-THIN": "refbthin", "C-THIN": "refcthin", 
+                  "RAILWAY": "refrail"},
+    "rotor": {"I": I, "II": II, "III": III, "IV": IV, "V": V, "VI": VI, "VII": VII, "VIII": VIII, 
+              "BETA": "beta", "GAMMA": "gamma", 
+              "RAILWAY-I": "rotorrailI", "RAILWAY-II": "rotorrailII", "RAILWAY-III": "rotorrailIII"},
+    "etw": {"ARMY": "etw_army", "COMMERCIAL": "etw_commercial", "TIRPITZ": "etw_tirpitz", 
+            "RAILWAY": "JWULCMNOHPQZYXIRADKEGVBTSF"},
+}
+
+# Machine models, the first reflector and ETW of a model are its defaults
+MODELS = {
+    "m3": {"name": "Enigma M3", "reflectors": ["B", "C"], "etws": ["ARMY"], "slots": 3,
+           "rotors": ["I", "II", "III", "IV", "V", "VI", "VII", "VIII"]},
+    "m4": {"name": "Enigma M4", "reflectors": ["B-THIN", "C-THIN"], "etws": ["ARMY"], "slots": 4,
+           "rotors": ["BETA", "GAMMA", "I", "II", "III", "IV", "V", "VI", "VII", "VIII"]},
+    "railway": {"name": "Railway Enigma", "reflectors": ["RAILWAY"], "etws": ["RAILWAY"], "slots": 3,
+                "rotors": ["RAILWAY-I", "RAILWAY-II", "RAILWAY-III"], "rotatable_reflector": True},
+    "commercial": {"name": "Commercial Enigma", "reflectors": ["A"], "etws": ["COMMERCIAL"], "slots": 3,
+                   "rotors": ["I", "II", "III"]},
+    "tirpitz": {"name": "Enigma with Tirpitz ETW", "reflectors": ["B", "C"], "etws": ["TIRPITZ"], "slots": 3,
+                "rotors": ["I", "II", "III", "IV", "V"]},
+}
+
+_wheels = {}
+
+
+def wheel(kind, name):
+    key = (kind, name)
+    if key not in _wheels:
+        if kind not in WHEELS or name not in WHEELS[kind]:
+            raise RuntimeError("Unknown {0}: {1}".format(kind, name))
+        source = WHEELS[kind][name]
+        if isinstance(source, int):
+            _wheels[key] = rotor(source)
+        elif len(source) == len(ALPHABET):
+            _wheels[key] = RotorSpec(ALPHABET, source, stepping=False)
+        else:
+            _wheels[key] = globals()[source]
+    return _wheels[key]
+
+
 class EnigmaPreset(object):
+    # Choices of a model from MODELS, listed as (label, wheel) on first use
+    model = "m3"
+    
     def __init__(self):
-        self.reflectors = []
-        self.rotors = []
-        self.stators = []
-        self.required_rotors = 3
-        self.rotatable_reflector = False 
+        model = MODELS[self.model]
+        self.required_rotors = model["slots"]
+        self.rotatable_reflector = model.get("rotatable_reflector", False)
         
         self._reflector_choice = None 
         self._rotors_choice = [] 
         self._stator_choice = None
-        
-
+    
+    def _options(self, kind, names, label):
+        return [("{0} {1}".format(label, name), wheel(kind, name)) for name in names]
+    
+    @property
+    def reflectors(self):
+        return self._options("reflector", MODELS[self.model]["reflectors"], "Reflector")
+    
+    @property
+    def rotors(self):
+        return self._options("rotor", MODELS[self.model]["rotors"], "Rotor")
+    
+    @property
+    def stators(self):
+        return self._options("etw", MODELS[self.model]["etws"], "ETW")
+    
     def ask_multiple_input(self, text, maxcount, required_count=None):
         while True:
             values = input(text).split(" ")
@@ -83,7 +148,7 @@ class EnigmaPreset(object):
         print_options(self.stators)
         choice = ask_input("Choose stator: ", len(self.stators))
         
-        self._reflector_choice = choice 
+        self._stator_choice = choice 
     
     def ask_options_rotors(self):
         print_options(self.rotors)
@@ -104,40 +169,193 @@ class EnigmaPreset(object):
         
         
 class EnigmaM3Preset(EnigmaPreset):
-    def __init__(self):
-        super().__init__()
-        self.reflectors = [("Reflector B", refb), ("Reflector C", refc)]
-        self.rotors = [("Rotor I", rotor(1)), ("Rotor II", rotor(2)),
-                        ("Rotor III", rotor(3)), ("Rotor IV", rotor(4)),
-                        ("Rotor V", rotor(1))]
-        self.stators = [("ETW Army", etw_army)]
+    model = "m3"
 
 
 class EnigmaM4Preset(EnigmaPreset):
-    def __init__(self):
-        super().__init__()
-        self.reflectors = [("Reflector B Thin", refbthin), ("Reflector C Thin", refcthin)]
-        self.rotors = [("Rotor I", rotor(1)), ("Rotor II", rotor(2)),
-                        ("Rotor III", rotor(3)), ("Rotor IV", rotor(4)),
-                        ("Rotor V", rotor(5)), ("Rotor VI", rotor(6)),
-                        ("Rotor VII", rotor(7)), ("Rotor VIII", rotor(8)),
-                        ("Rotor VII", rotor(7)), ("Rotor VIII", rotor(8))]
-        self.stators = [("ETW Army", etw_army)]
+    model = "m4"
 
 
 class EnigmaRocketPreset(EnigmaPreset):
-    def __init__(self):
-        super().__init__()
-        self.reflectors = [("Reflector B", refb), ("Reflector C", refc)]
-        self.rotors = [("Rotor I", rotor(1)), ("Rotor II", rotor(2)),
-                        ("Rotor III", rotor(3)), ("Rotor IV", rotor(4)),
-                        ("Rotor V", rotor(1))]
-        self.stators = [("ETW Army", etw_army)]
+    model = "railway"
+
+
+class EnigmaCommercialPreset(EnigmaPreset):
+    model = "commercial"
+
+
+class EnigmaTirpitzPreset(EnigmaPreset):
+    model = "tirpitz"
 
 
+enigmas = [(MODELS[cls.model]["name"], cls) for cls in 
+           (EnigmaM3Preset, EnigmaM4Preset, EnigmaRocketPreset, EnigmaCommercialPreset, EnigmaTirpitzPreset)]
+
+
+KEY_OPTIONS = ["model", "reflector", "etw", "rotors", "rings", "state", "plugboard"]
+
+
+def read_key_file(path):
+    # One setting per line, e.g. "rotors II IV V" or "plugboard AV BS CG"
+    key = {}
+    with open(path) as f:
+        for line in f:
+            line = line.split("#")[0].strip()
+            if not line:
+                continue 
+            name, _, value = line.partition(" ")
+            if name not in KEY_OPTIONS:
+                raise RuntimeError("Unknown key file setting: {0}".format(name))
+            key[name] = value.strip()
+    return key 
+
+
+def parse_rings(value):
+    values = value.split()
+    if values[0].isdigit():
+        return [int(x)-1 for x in values]
+    else:
+        return list(offsets("".join(values).upper()))
+
+
+def build_machine(key, cache=None):
+    # Compiled machine for the settings of a key file. With a TableCache the 
+    # tables of the wheels are read from disk when they were built before.
+    name = key.get("model", "m3").lower()
+    if name not in MODELS:
+        raise RuntimeError("Unsupported model: {0}".format(name))
+    model = MODELS[name]
+    reflector = wheel("reflector", key.get("reflector", model["reflectors"][0]).upper())
+    etw = wheel("etw", key.get("etw", model["etws"][0]).upper())
+    
+    names = key["rotors"].upper().split()
+    numerals = ["I", "II", "III", "IV", "V", "VI", "VII", "VIII"]
+    # Numbers out of range are left as they are and reported by wheel 
+    names = [numerals[int(x)-1] if x.isdigit() and 1 <= int(x) <= len(numerals) else x for x in names]
+    if len(names) != model["slots"]:
+        raise RuntimeError("Model {0} needs {1} rotors".format(name, model["slots"]))
+    rotors = [wheel("rotor", x) for x in names]
+    
+    plugboard = key.get("plugboard", "").upper().split()
+    machine = EnigmaMachine(reflector, rotors, etw, plugboard, 
+                            rotatable_reflector=model.get("rotatable_reflector", False))
+    if "rings" in key:
+        machine.set_ring(*parse_rings(key["rings"]))
+    if "state" in key:
+        machine.set_rotor_state(key["state"].upper())
+    return machine.compile(cache)
+
+
+def open_text(path, mode):
+    # Text files are read and written as UTF-8 without newline translation, 
+    # so the output keeps the line endings of the input. Bytes that are not 
+    # UTF-8 come through as surrogates, which encode turns into X like any 
+    # other character outside the alphabet.
+    return open(path, mode, encoding="utf-8", errors="surrogateescape", newline="")
+
+
+def text_stream(buffer):
+    return io.TextIOWrapper(buffer, encoding="utf-8", errors="surrogateescape", newline="")
+
+
+def process_stream(key, src, dst, binary=False, decode=False, codec=CODEC_BASE32, chunk_size=1024*1024,
+                   cache=None):
+    machine = build_machine(key, cache)
+    if binary:
+        data_enigma = ArbitraryDataEnigma(machine, codec)
+        if decode:
+            data_enigma.decode_stream(src, dst, chunk_size)
+        else:
+            data_enigma.encode_stream(src, dst, chunk_size)
+    else:
+        while True:
+            text = src.read(chunk_size)
+            if not text:
+                break 
+            dst.write(machine.encode(text))
+
+
+def process_file(key, path, output, binary=False, decode=False, codec=CODEC_BASE32, chunk_size=1024*1024,
+                 cache=None):
+    opener = open if binary else open_text
+    mode = "b" if binary else ""
+    with opener(path, "r" + mode) as src, opener(output, "w" + mode) as dst:
+        process_stream(key, src, dst, binary, decode, codec, chunk_size, cache)
+    return output 
+
+
+def batch_main(argv=None):
+    parser = argparse.ArgumentParser(description="Encrypt or decrypt files with an Enigma machine")
+    parser.add_argument("files", nargs="*", help="files to process, stdin if none are given")
+    parser.add_argument("--key-file", help="file with one setting per line, overridden by the options below")
+    parser.add_argument("--model", choices=sorted(MODELS))
+    parser.add_argument("--reflector", help="one of " + ", ".join(sorted(WHEELS["reflector"])))
+    parser.add_argument("--etw", help="one of " + ", ".join(sorted(WHEELS["etw"])))
+    parser.add_argument("--rotors", help="rotors from left to right, e.g. \"II IV V\"")
+    parser.add_argument("--rings", help="ring settings as numbers (\"2 21 12\") or letters (\"BUL\")")
+    parser.add_argument("--state", help="start rotor state, e.g. BLA")
+    parser.add_argument("--plugboard", help="plug pairs, e.g. \"AV BS CG\"")
+    parser.add_argument("--binary", action="store_true", help="process arbitrary bytes with ArbitraryDataEnigma")
+    parser.add_argument("--decode", action="store_true", help="decode ciphertext back to bytes in binary mode")
+    parser.add_argument("--codec", choices=["base32", "radix26"], default="base32")
+    parser.add_argument("-o", "--output", help="output file for a single input, stdout by default")
+    parser.add_argument("--output-dir", help="directory for the outputs when processing several files")
+    parser.add_argument("--workers", type=int, default=None, help="processes for encrypting several files")
+    parser.add_argument("--chunk-size", type=int, default=1024*1024)
+    parser.add_argument("--cache-dir", help="directory of the compiled table cache, $ENIGMA_CACHE_DIR or "
+                                            "~/.cache/enigma by default")
+    parser.add_argument("--no-cache", action="store_true", help="always build the tables")
+    args = parser.parse_args(argv)
+    
+    key = read_key_file(args.key_file) if args.key_file else {}
+    for name in KEY_OPTIONS:
+        if getattr(args, name) is not None:
+            key[name] = getattr(args, name)
+    if "rotors" not in key:
+        parser.error("the rotors have to be given as option or in the key file")
+    codec = CODEC_RADIX26 if args.codec == "radix26" else CODEC_BASE32
+    cache = None if args.no_cache else TableCache(args.cache_dir)
+    # Settings are checked before any file is opened, unknown wheels or 
+    # wrong counts are usage errors
+    try:
+        build_machine(key, cache)
+    except (RuntimeError, ValueError, AssertionError) as error:
+        parser.error(str(error) or "invalid settings")
+    options = (args.binary, args.decode, codec, args.chunk_size, cache)
+    
+    if len(args.files) > 1:
+        if args.output_dir is None:
+            parser.error("--output-dir is required for several files")
+        os.makedirs(args.output_dir, exist_ok=True)
+        outputs = [os.path.join(args.output_dir, os.path.basename(path)) for path in args.files]
+        # Imported here to keep the startup of single file runs short
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=args.workers) as executor:
+            futures = [executor.submit(process_file, key, path, output, *options) 
+                       for path, output in zip(args.files, outputs)]
+            for future in futures:
+                print(future.result(), file=sys.stderr)
+    elif args.files and args.output:
+        process_file(key, args.files[0], args.output, *options)
+    else:
+        if args.files:
+            src = open(args.files[0], "rb") if args.binary else open_text(args.files[0], "r")
+        else:
+            src = sys.stdin.buffer if args.binary else text_stream(sys.stdin.buffer)
+        if args.output:
+            dst = open(args.output, "wb") if args.binary else open_text(args.output, "w")
+        else:
+            dst = sys.stdout.buffer if args.binary else text_stream(sys.stdout.buffer)
+        process_stream(key, src, dst, *options)
+        dst.flush()
+        if not args.binary and not args.output:
+            # Leaves sys.stdout.buffer open
+            dst.detach()
+    return 0
 
 
-enigmas = [("Enigma M3", EnigmaM3Preset)]
+if __name__ == "__main__" and len(sys.argv) > 1:
+    sys.exit(batch_main())
 
 if __name__ == "__main__":  
     stop = False 
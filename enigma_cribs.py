@@ -0,0 +1,112 @@
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+from enigma import *
+from enigma_bombe import bombe, letters_only
+
+
+Placement = namedtuple("Placement", ["message", "crib", "position", "loops"])
+
+
+def letter_bitsets(np, letters):
+    # One int per letter of the alphabet with bit i set where letters[i] is
+    # that letter
+    codes = np.frombuffer(letters.encode("ascii"), dtype=np.uint8) - ord("A")
+    return [int.from_bytes(np.packbits(codes == x, bitorder="little").tobytes(), "little")
+            for x in range(26)]
+
+
+def bitset_positions(np, bits, count):
+    data = np.frombuffer(bits.to_bytes(-(-count // 8), "little"), dtype=np.uint8)
+    return np.flatnonzero(np.unpackbits(data, count=count, bitorder="little"))
+
+
+def crib_positions(ciphertext, cribs):
+    # Positions among the letters of the ciphertext where each crib can be
+    # placed without any letter encrypting to itself, as a dict of crib to
+    # array of positions. Every crib letter rules out the positions where
+    # the ciphertext has the same letter under it, which is the bitset of
+    # that letter shifted by the index of the letter in the crib.
+    np = import_numpy()
+    letters = letters_only(ciphertext)
+    bitsets = letter_bitsets(np, letters)
+    if isinstance(cribs, str):
+        cribs = [cribs]
+
+    result = {}
+    for crib in cribs:
+        crib = letters_only(crib)
+        count = len(letters) - len(crib) + 1
+        if count <= 0 or not crib:
+            result[crib] = np.zeros(0, dtype=np.intp)
+            continue
+        clashes = 0
+        for i, letter in enumerate(crib):
+            clashes |= bitsets[offset(letter)] >> i
+        valid = ~clashes & ((1 << count) - 1)
+        result[crib] = bitset_positions(np, valid, count)
+    return result
+
+
+def find_placements(ciphertexts, cribs):
+    # Valid positions of all cribs in all ciphertexts, as a list with the
+    # dict of crib_positions of every ciphertext. Nothing is done per
+    # position, use rank_placements to count the loops of the menus.
+    return [crib_positions(ciphertext, cribs) for ciphertext in ciphertexts]
+
+
+def loop_count(crib, letters, position):
+    # Number of loops of the menu of a placement, like len(find_loops(menu))
+    # but without building the menu: an edge closes a loop when its letters
+    # are already connected. crib and letters are lists of letter indices.
+    parent = list(range(26))
+    loops = 0
+    for plain, cipher in zip(crib, letters[position:position+len(crib)]):
+        while parent[plain] != plain:
+            plain = parent[plain]
+        while parent[cipher] != cipher:
+            cipher = parent[cipher]
+        if plain == cipher:
+            loops += 1
+        else:
+            parent[plain] = cipher
+    return loops
+
+
+def _message_placements(number, ciphertext, positions, min_loops):
+    letters = list(offsets(letters_only(ciphertext)))
+    placements = []
+    for crib, found in positions.items():
+        codes = list(offsets(crib))
+        for position in found.tolist():
+            loops = loop_count(codes, letters, position)
+            if loops >= min_loops:
+                placements.append(Placement(number, crib, position, loops))
+    return placements
+
+
+def rank_placements(ciphertexts, cribs, min_loops=1, positions=None, workers=None):
+    # Placements of find_placements with the number of loops of each menu,
+    # the most loops first, the placements most worth a bombe run. This
+    # counts every position in Python, so it is opt-in and the positions can
+    # be narrowed down first by passing a filtered result of find_placements.
+    # Messages are counted in worker processes unless workers is 1.
+    if positions is None:
+        positions = find_placements(ciphertexts, cribs)
+    if workers == 1:
+        results = [_message_placements(number, ciphertext, message_positions, min_loops)
+                   for number, (ciphertext, message_positions) in enumerate(zip(ciphertexts, positions))]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(_message_placements, range(len(ciphertexts)), ciphertexts, positions,
+                                        [min_loops]*len(ciphertexts), chunksize=64))
+    placements = [placement for result in results for placement in result]
+    placements.sort(key=lambda x: (-x.loops, x.message, x.position))
+    return placements
+
+
+def run_placements(ciphertexts, placements, **options):
+    # Runs the bombe for every placement of rank_placements, best first, and
+    # yields each placement with its stops. options are passed on to bombe.
+    for placement in placements:
+        yield placement, bombe(ciphertexts[placement.message], placement.crib, placement.position, **options)
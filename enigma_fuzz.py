@@ -0,0 +1,249 @@
+import argparse
+import json
+import sys
+import time
+from collections import namedtuple
+from random import Random
+
+from enigma import *
+from enigma_cli import MODELS, WHEELS, wheel
+
+
+Mismatch = namedtuple("Mismatch", ["backend", "config", "text", "expected", "result"])
+
+# Characters for random texts: letters in both cases, whitespace that is
+# passed through, characters that become X and ones that upper-case to
+# several letters
+LETTERS = ALPHABET + ALPHABET.lower()
+OTHERS = " \t\n\r\x0b\x0c\xa0 　" + "0123456789.,:;!?-'\"()" + "\xe4\xf6\xfc\xe9\xdfﬆŉ☃"
+
+
+def _encode_compiled(machine, text):
+    return machine.compile().encode(text)
+
+
+def _encode_cached(machine, text):
+    machine.permutation_cache = PermutationCache(64)
+    return machine.encode(text)
+
+
+def _encode_vectorized(machine, text):
+    return machine.encode_vectorized(text)
+
+
+def _encode_parallel(machine, text):
+    return machine.compile().encode_parallel(text, workers=2)
+
+
+def _encode_into(machine, text, vectorized=False):
+    # Only texts of Latin-1 characters can be given as bytes
+    try:
+        data = bytearray(text.encode("latin-1"))
+    except UnicodeEncodeError:
+        return None
+    machine.encode_into(data, data, vectorized)
+    return data.decode("latin-1")
+
+
+def _encode_into_vectorized(machine, text):
+    return _encode_into(machine, text, True)
+
+
+def _encode_instrumented(machine, text):
+    machine.instrument()
+    return machine.encode(text)
+
+
+def _encode_keysheet(machine, text):
+    from enigma_keysheet import encode_keys
+    return encode_keys(text, [machine])[0]
+
+
+# Fast engines by name, each encodes text on a fresh machine and leaves the
+# machine at its final position, or returns None if it cannot take the
+# text. Backends that are slow to start are left out of the defaults.
+BACKENDS = {
+    "compiled": _encode_compiled,
+    "cached": _encode_cached,
+    "vectorized": _encode_vectorized,
+    "encode_into": _encode_into,
+    "encode_into_vectorized": _encode_into_vectorized,
+    "instrumented": _encode_instrumented,
+    "keysheet": _encode_keysheet,
+    "parallel": _encode_parallel,
+}
+DEFAULT_BACKENDS = ["compiled", "cached", "vectorized", "encode_into", "encode_into_vectorized",
+                    "instrumented", "keysheet"]
+
+
+def register_backend(name, function, default=True):
+    BACKENDS[name] = function
+    if default and name not in DEFAULT_BACKENDS:
+        DEFAULT_BACKENDS.append(name)
+
+
+def random_config(rng):
+    # Settings of a random machine: a model and any of the rotors for its
+    # slots, as with a mix of wheels from different models
+    model = rng.choice(sorted(MODELS))
+    slots = MODELS[model]["slots"]
+    rotatable = MODELS[model].get("rotatable_reflector", False)
+    letters = rng.sample(ALPHABET, 26)
+    pairs = rng.randint(0, 13)
+    return {
+        "model": model,
+        "reflector": rng.choice(MODELS[model]["reflectors"]),
+        "etw": rng.choice(sorted(WHEELS["etw"])),
+        "rotors": [rng.choice(sorted(WHEELS["rotor"])) for i in range(slots)],
+        "rings": [rng.randrange(26) for i in range(slots + rotatable)],
+        "state": "".join(rng.choice(ALPHABET) for i in range(slots + rotatable)),
+        "plugboard": [letters[2*i] + letters[2*i+1] for i in range(pairs)],
+    }
+
+
+def make_machine(config):
+    # Machine on the reference path, neither compiled nor cached
+    machine = EnigmaMachine(wheel("reflector", config["reflector"]),
+                            [wheel("rotor", x) for x in config["rotors"]],
+                            wheel("etw", config["etw"]), config["plugboard"],
+                            rotatable_reflector=MODELS[config["model"]].get("rotatable_reflector", False))
+    machine.set_ring(*config["rings"])
+    machine.set_rotor_state(config["state"])
+    return machine
+
+
+def random_text(rng, length):
+    # Half of the texts stay within Latin-1, so the backends taking bytes get them too
+    others = OTHERS if rng.random() < 0.5 else [x for x in OTHERS if ord(x) < 256]
+    return "".join(rng.choice(LETTERS) if rng.random() < 0.8 else rng.choice(others) for i in range(length))
+
+
+def run_case(config, text, backend):
+    # (expected, result) as output and final rotor state, result is None if
+    # the backend cannot take the text. Also returns both run times.
+    reference = make_machine(config)
+    start = time.perf_counter()
+    expected = (reference.encode(text), reference.get_rotor_state())
+    reference_time = time.perf_counter() - start
+
+    machine = make_machine(config)
+    start = time.perf_counter()
+    output = BACKENDS[backend](machine, text)
+    backend_time = time.perf_counter() - start
+    result = None if output is None else (output, machine.get_rotor_state())
+    return expected, result, reference_time, backend_time
+
+
+def fails(config, text, backend):
+    expected, result, reference_time, backend_time = run_case(config, text, backend)
+    return result is not None and result != expected
+
+
+def minimize_text(config, text, backend):
+    # Delta debugging: drops ever smaller pieces of the text while it fails
+    parts = 2
+    while len(text) >= 2:
+        size = -(-len(text) // parts)
+        for begin in range(0, len(text), size):
+            candidate = text[:begin] + text[begin+size:]
+            if fails(config, candidate, backend):
+                text = candidate
+                parts = max(parts-1, 2)
+                break
+        else:
+            if parts >= len(text):
+                break
+            parts = min(parts*2, len(text))
+    return text
+
+
+def minimize_config(config, text, backend):
+    # Removes plugs and zeroes ring settings and rotor positions while it fails
+    def simpler(config):
+        for i in range(len(config["plugboard"])):
+            yield dict(config, plugboard=config["plugboard"][:i] + config["plugboard"][i+1:])
+        for i, ring in enumerate(config["rings"]):
+            if ring:
+                yield dict(config, rings=config["rings"][:i] + [0] + config["rings"][i+1:])
+        for i, letter in enumerate(config["state"]):
+            if letter != "A":
+                yield dict(config, state=config["state"][:i] + "A" + config["state"][i+1:])
+
+    changed = True
+    while changed:
+        changed = False
+        for candidate in simpler(config):
+            if fails(candidate, text, backend):
+                config = candidate
+                changed = True
+                break
+    return config
+
+
+def minimize(config, text, backend):
+    text = minimize_text(config, text, backend)
+    config = minimize_config(config, text, backend)
+    return config, minimize_text(config, text, backend)
+
+
+def fuzz(cases=200, max_length=2000, backends=None, seed=0, log=None):
+    # Runs random cases through the reference path and every backend.
+    # Returns the minimized mismatches and, per model and backend, the
+    # speedup over the reference path as the ratio of the summed run times.
+    rng = Random(seed)
+    backends = DEFAULT_BACKENDS if backends is None else backends
+    mismatches = []
+    times = {}
+    for case in range(cases):
+        config = random_config(rng)
+        text = random_text(rng, rng.randint(0, max_length))
+        for backend in backends:
+            expected, result, reference_time, backend_time = run_case(config, text, backend)
+            if result is None:
+                continue
+            total = times.setdefault((config["model"], backend), [0.0, 0.0])
+            total[0] += reference_time
+            total[1] += backend_time
+            if result != expected:
+                small_config, small_text = minimize(config, text, backend)
+                small = run_case(small_config, small_text, backend)
+                mismatch = Mismatch(backend, small_config, small_text, small[0], small[1])
+                mismatches.append(mismatch)
+                if log is not None:
+                    log(mismatch)
+
+    speedups = dict((key, reference / max(backend, 1e-9)) for key, (reference, backend) in times.items())
+    return mismatches, speedups
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Differential fuzzing of the fast engines against push_key")
+    parser.add_argument("--cases", type=int, default=200)
+    parser.add_argument("--max-length", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--backends", help="comma separated, from " + ", ".join(sorted(BACKENDS)))
+    parser.add_argument("--output", help="write the report as JSON to this file")
+    args = parser.parse_args(argv)
+
+    def log(mismatch):
+        print("Mismatch in {0}: {1!r} with {2}".format(mismatch.backend, mismatch.text, mismatch.config),
+              file=sys.stderr)
+
+    backends = args.backends.split(",") if args.backends else None
+    mismatches, speedups = fuzz(args.cases, args.max_length, backends, args.seed, log)
+
+    report = {"cases": args.cases, "seed": args.seed,
+              "mismatches": [mismatch._asdict() for mismatch in mismatches],
+              "speedups": [{"model": model, "backend": backend, "speedup": value}
+                           for (model, backend), value in sorted(speedups.items())]}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    for row in report["speedups"]:
+        print("{model:12} {backend:24} {speedup:8.2f}x".format(**row))
+    print("{0} mismatches".format(len(mismatches)))
+    return 1 if mismatches else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
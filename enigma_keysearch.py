@@ -0,0 +1,133 @@
+import heapq
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from itertools import count, permutations
+
+from enigma import *
+
+
+Candidate = namedtuple("Candidate", ["score", "reflector", "wheel_order", "rings", "rotor_state"])
+
+REFLECTORS = [("B", refb), ("C", refc)]
+
+
+def start_positions(slots, batch_size):
+    # Every start position of slots rotors in batches of batch_size, as the
+    # numbers of the start positions, counting them as base 26 numbers of
+    # the rotations left to right, and their rotations with one row each
+    np = import_numpy()
+    for begin in range(0, 26**slots, batch_size):
+        index = np.arange(begin, min(begin+batch_size, 26**slots))
+        yield index, np.stack([(index // 26**(slots-1-i)) % 26 for i in range(slots)], axis=1)
+
+
+def wheel_order_jobs(reflectors, rotors, slots):
+    # (reflector name, reflector, wheel order) of every combination to try
+    return [(name, reflector, order) for name, reflector in reflectors
+            for order in permutations(rotors, slots)]
+
+
+def run_jobs(function, jobs, workers=None):
+    # Calls function with the arguments of every job and yields the number
+    # of the job and its result as they finish, in this process if workers
+    # is 1 and in worker processes otherwise. Jobs not started yet are
+    # cancelled when the caller stops early.
+    if workers == 1:
+        for number, args in enumerate(jobs):
+            yield number, function(*args)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = dict((executor.submit(function, *args), number) for number, args in enumerate(jobs))
+        try:
+            for future in as_completed(futures):
+                yield futures[future], future.result()
+        finally:
+            for future in futures:
+                future.cancel()
+
+
+def index_of_coincidence(text):
+    counts = [0]*len(ALPHABET)
+    for letter in text:
+        if letter in ALPHABET:
+            counts[offset(letter)] += 1
+
+    total = sum(counts)
+    if total < 2:
+        return 0.0
+    return sum(x*(x-1) for x in counts) / (total*(total-1))
+
+
+def score_wheel_order(ciphertext, reflector, wheel_order, rings, etw=etw_army, plugboard=None,
+                      top=10, batch_size=4096):
+    # Decrypts the ciphertext at every start position of one wheel order and
+    # returns the best (score, rotor state) pairs by index of coincidence.
+    np = import_numpy()
+    machine = EnigmaMachine(reflector, [rotor(x) for x in wheel_order], etw, plugboard)
+    machine.set_ring(*rings)
+    machine.compile()
+
+    slots = len(wheel_order)
+    best = []
+    for index, rotations in start_positions(slots, batch_size):
+        letters = machine.encode_batch(ciphertext, rotations)
+
+        length = letters.shape[1]
+        rows = np.arange(len(index))[:, None]*26
+        counts = np.bincount((letters + rows).ravel(), minlength=26*len(index)).reshape(-1, 26)
+        scores = (counts*(counts-1)).sum(axis=1) / max(length*(length-1), 1)
+
+        for row in np.argsort(scores)[-top:]:
+            state = "".join(ALPHABET[x] for x in rotations[row])
+            heapq.heappush(best, (float(scores[row]), state))
+            if len(best) > top:
+                heapq.heappop(best)
+
+    return best
+
+
+def search(ciphertext, reflectors=REFLECTORS, rotors=(I, II, III, IV, V), rings=(0, 0, 0),
+           etw=etw_army, plugboard=None, top=10, threshold=None, progress=None, workers=None,
+           batch_size=4096):
+    # Ciphertext-only search over reflectors, wheel orders and start positions
+    # for one ring setting. Returns the top candidates, best first. progress
+    # is called with (done, total, best candidate) after every wheel order,
+    # and the search stops early once a candidate scores at least threshold.
+    jobs = wheel_order_jobs(reflectors, rotors, len(rings))
+    best = []
+    tiebreak = count()
+
+    def collect(name, order, results):
+        for score, state in results:
+            candidate = Candidate(score, name, order, tuple(rings), state)
+            heapq.heappush(best, (score, next(tiebreak), candidate))
+            if len(best) > top:
+                heapq.heappop(best)
+
+        leader = max(best)[2] if best else None
+        if progress is not None:
+            progress(done, len(jobs), leader)
+        return threshold is not None and leader is not None and leader.score >= threshold
+
+    done = 0
+    arguments = [(ciphertext, reflector, order, rings, etw, plugboard, top, batch_size)
+                 for name, reflector, order in jobs]
+    for number, results in run_jobs(score_wheel_order, arguments, workers):
+        name, reflector, order = jobs[number]
+        done += 1
+        if collect(name, order, results):
+            break
+
+    return [candidate for score, i, candidate in sorted(best, reverse=True)]
+
+
+if __name__ == "__main__":
+    import sys
+
+    def report(done, total, leader):
+        print("{0}/{1} wheel orders, best so far: {2}".format(done, total, leader), file=sys.stderr)
+
+    ciphertext = sys.stdin.read()
+    for candidate in search(ciphertext, progress=report):
+        print(candidate)
@@ -0,0 +1,153 @@
+import csv
+import sys
+
+from enigma import *
+from enigma_cli import KEY_OPTIONS, build_machine
+
+
+# Settings of a key as in a key file of the batch mode, empty fields use the
+# defaults of the model
+KEY_DTYPE = [("model", "U16"), ("reflector", "U16"), ("etw", "U16"), ("rotors", "U64"),
+             ("rings", "U32"), ("state", "U8"), ("plugboard", "U64")]
+
+
+def read_keysheet(path):
+    # CSV key sheet with a header row naming the settings, e.g.
+    # "rotors,rings,state,plugboard". Returns a structured array of KEY_DTYPE.
+    np = import_numpy()
+    with open(path, newline="") as f:
+        reader = csv.DictReader(f)
+        for name in reader.fieldnames or ():
+            if name.strip() not in KEY_OPTIONS:
+                raise RuntimeError("Unknown key sheet column: {0}".format(name))
+        rows = [dict((name.strip(), (value or "").strip()) for name, value in row.items()) for row in reader]
+    return np.array([tuple(row.get(name, "") for name, dtype in KEY_DTYPE) for row in rows], dtype=KEY_DTYPE)
+
+
+def key_rows(keys):
+    # Settings of every row of a structured array of keys as in a key file,
+    # leaving out empty fields
+    names = keys.dtype.names
+    for row in keys:
+        yield dict((name, str(row[name])) for name in names if str(row[name]).strip())
+
+
+def key_machines(keys, cache=None):
+    # Compiled machines for the rows of a structured array of keys
+    for key in key_rows(keys):
+        yield build_machine(key, cache)
+
+
+def _stack_tables(np, machines):
+    # Wiring tables of all distinct wheels of the machines stacked into one
+    # array, and the index into it of every rotor (right to left, one row per
+    # slot) and of every reflector
+    index = {}
+    tables = []
+
+    def lookup(spec):
+        wiring = (spec.in_map, spec.out_map)
+        if wiring not in index:
+            index[wiring] = len(tables)
+            tables.append(spec.tables())
+        return index[wiring]
+
+    rotors = np.array([[lookup(rotor) for rotor in reversed(machine.rotors)] for machine in machines],
+                      dtype=np.intp).T
+    reflectors = np.array([lookup(machine.reflector) for machine in machines], dtype=np.intp)
+    forward = np.array([table[0] for table in tables], dtype=np.intp)
+    backward = np.array([table[1] for table in tables], dtype=np.intp)
+    return forward, backward, rotors, reflectors
+
+
+def _key_notches(np, machines):
+    # Notches of every rotor slot (right to left) as arrays with one entry per
+    # machine, padded with -1 for rotors with fewer notches
+    notches = []
+    for i in range(len(machines[0].rotors)):
+        per_machine = [machine.rotors[-1-i].notches() for machine in machines]
+        width = max(len(x) for x in per_machine)
+        notches.append([np.array([x[j] if j < len(x) else -1 for x in per_machine], dtype=np.intp)
+                        for j in range(width)])
+    return notches
+
+
+def _encode_group(np, machines, codes):
+    # Output letter indices of the key presses in codes for machines with the
+    # same number of rotors, one row per machine. Moves the machines on.
+    count = len(codes)
+    slots = len(machines[0].rotors)
+    forward, backward, rotors, reflectors = _stack_tables(np, machines)
+    notches = _key_notches(np, machines)
+    stepping = [np.array([machine.rotors[-1-i].stepping for machine in machines]) for i in range(slots)]
+
+    # Rotor offsets of every machine after every key press
+    rotor_offsets = np.array([machine.get_offsets() for machine in machines], dtype=np.intp).T.copy()
+    positions = np.empty((slots, len(machines), count), dtype=np.intp)
+    for key in range(count):
+        step_offsets_array(rotor_offsets, notches, stepping)
+        positions[:, :, key] = rotor_offsets
+    for k, machine in enumerate(machines):
+        machine.set_offsets(rotor_offsets[:, k].tolist())
+
+    rows = np.arange(len(machines))[:, None]
+    compiled = [machine.tables() for machine in machines]
+    entry = np.array([tables[0] for tables in compiled], dtype=np.intp)
+    output = np.array([[offset(x) for x in tables[1]] for tables in compiled], dtype=np.uint8)
+    reflection = np.array([machine.reflector.offset(machine.state.reflector) for machine in machines],
+                          dtype=np.intp)
+
+    letters = entry[rows, codes[None, :]]
+    for i in range(slots):
+        letters = forward[rotors[i][:, None], positions[i], letters]
+    letters = forward[reflectors[:, None], reflection[:, None], letters]
+    for i in range(slots-1, -1, -1):
+        letters = backward[rotors[i][:, None], positions[i], letters]
+    return output[rows, letters]
+
+
+def encode_keys(text, machines, chunk_size=None):
+    # Encodes text on every machine, like calling encode on each of them, but
+    # with the stepping and the substitutions of all machines and key presses
+    # computed as arrays. chunk_size is the number of machines per pass and
+    # bounds the memory used, by default about 4M rotor positions per pass.
+    np = import_numpy()
+    is_ascii = text.isascii()
+    if is_ascii:
+        data = np.frombuffer(text.encode("ascii"), dtype=np.uint8)
+    else:
+        data = np.frombuffer(text.encode("utf-32-le"), dtype=np.uint32)
+    codes = np.array([key_code(letter) for letter in text], dtype=np.intp)
+    keys = np.flatnonzero(codes >= 0)
+    codes = codes[keys]
+    if chunk_size is None:
+        chunk_size = max(1, 2**22 // max(len(codes)*4, 1))
+
+    groups = {}
+    for k, machine in enumerate(machines):
+        groups.setdefault(len(machine.rotors), []).append(k)
+
+    alphabet = np.frombuffer(ALPHABET.encode("ascii"), dtype=np.uint8)
+    results = [None]*len(machines)
+    for indices in groups.values():
+        for begin in range(0, len(indices), chunk_size):
+            chunk = indices[begin:begin+chunk_size]
+            letters = _encode_group(np, [machines[k] for k in chunk], codes)
+            rows = np.broadcast_to(data, (len(chunk), len(data))).copy()
+            rows[:, keys] = alphabet[letters]
+            for k, row in zip(chunk, rows):
+                results[k] = row.tobytes().decode("ascii" if is_ascii else "utf-32-le")
+    return results
+
+
+def encrypt_keysheet(text, keys, chunk_size=None):
+    # Ciphertexts of text under every key of a structured array or CSV key sheet
+    if isinstance(keys, str):
+        keys = read_keysheet(keys)
+    return encode_keys(text, list(key_machines(keys)), chunk_size)
+
+
+if __name__ == "__main__":
+    text = sys.stdin.read().rstrip("\n")
+    for ciphertext in encrypt_keysheet(text, sys.argv[1]):
+        print(ciphertext)
@@ -0,0 +1,201 @@
+import math
+from concurrent.futures import ProcessPoolExecutor
+from random import Random
+
+from enigma import *
+
+
+class NgramTable(object):
+    # Log10 probabilities of all n-grams as a flat array indexed by the
+    # letter indices of the n-gram read as a base 26 number.
+    def __init__(self, n, log_probabilities):
+        self.n = n
+        self.log_probabilities = log_probabilities
+
+    @classmethod
+    def from_counts(cls, counts, floor=0.01):
+        np = import_numpy()
+        n = len(next(iter(counts)))
+        total = float(sum(counts.values()))
+        table = np.full(26**n, math.log10(floor/total))
+        for gram, value in counts.items():
+            index = 0
+            for letter in gram:
+                index = index*26 + offset(letter)
+            table[index] = math.log10(value/total)
+        return cls(n, table)
+
+    @classmethod
+    def from_text(cls, text, n, floor=0.01):
+        letters = "".join(x for x in text.upper() if x in ALPHABET)
+        counts = {}
+        for i in range(len(letters)-n+1):
+            gram = letters[i:i+n]
+            counts[gram] = counts.get(gram, 0) + 1
+        return cls.from_counts(counts, floor)
+
+    @classmethod
+    def load(cls, path, floor=0.01):
+        # One "NGRAM COUNT" pair per line, the usual format of published n-gram lists
+        counts = {}
+        with open(path) as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) == 2:
+                    counts[parts[0].upper()] = int(parts[1])
+        return cls.from_counts(counts, floor)
+
+    def windows(self, letters, starts=None):
+        # Table index of the n-gram starting at every position (or at starts)
+        np = import_numpy()
+        letters = np.asarray(letters, dtype=np.intp)
+        if starts is None:
+            starts = np.arange(max(len(letters)-self.n+1, 0))
+        index = np.zeros(len(starts), dtype=np.intp)
+        for k in range(self.n):
+            index = index*26 + letters[starts+k]
+        return index
+
+    def score(self, letters):
+        return float(self.log_probabilities[self.windows(letters)].sum())
+
+
+def scrambler_table(machine, count):
+    # Substitution of the machine without its plugboard for the first count
+    # key presses, indexed by [key press, letter]
+    bare = EnigmaMachine(machine.reflector, machine.rotors, machine.etw,
+                         rotatable_reflector=machine.rotatable_reflector)
+    bare.restore(machine.snapshot())
+    return bare.permutation_batch([bare.state.rotations], range(count))[0].astype("intp")
+
+
+class PlugboardClimber(object):
+    # Keeps the decrypt and its n-gram scores for the current plugboard, so a
+    # change of a few plugs only rescores the n-grams it touches.
+    def __init__(self, ciphertext, scrambler, table, plug=None):
+        np = import_numpy()
+        self.np = np
+        self.cipher = np.array([offset(x) for x in ciphertext], dtype=np.intp)
+        self.scrambler = scrambler
+        self.table = table
+        self.positions = np.arange(len(self.cipher))
+        self.set_plug(np.arange(26) if plug is None else np.asarray(plug, dtype=np.intp))
+
+    def set_plug(self, plug):
+        self.plug = plug.copy()
+        self.middle = self.scrambler[self.positions, plug[self.cipher]]
+        self.letters = plug[self.middle]
+        self.grams = self.table.log_probabilities[self.table.windows(self.letters)]
+        self.score = float(self.grams.sum())
+
+    def pairs(self):
+        return sorted(ALPHABET[a] + ALPHABET[b] for a, b in enumerate(self.plug) if a < b)
+
+    def trial(self, plug, changed):
+        # Score of the decrypt under plug, which differs from the current
+        # plugboard in the letters changed. Returns the score and the state
+        # needed by accept.
+        np = self.np
+        touched = np.zeros(26, dtype=bool)
+        touched[changed] = True
+        affected = np.flatnonzero(touched[self.cipher] | touched[self.middle])
+
+        middle = self.scrambler[affected, plug[self.cipher[affected]]]
+        letters = self.letters.copy()
+        letters[affected] = plug[middle]
+
+        n = self.table.n
+        windows = np.zeros(len(self.grams), dtype=bool)
+        for k in range(n):
+            starts = affected - k
+            windows[starts[(starts >= 0) & (starts < len(windows))]] = True
+        windows = np.flatnonzero(windows)
+        grams = self.table.log_probabilities[self.table.windows(letters, windows)]
+
+        score = self.score - float(self.grams[windows].sum()) + float(grams.sum())
+        return score, (plug, affected, middle, letters, windows, grams)
+
+    def accept(self, score, change):
+        plug, affected, middle, letters, windows, grams = change
+        self.plug = plug
+        self.middle[affected] = middle
+        self.letters = letters
+        self.grams[windows] = grams
+        self.score = score
+
+
+def moves(plug, a, b, max_pairs):
+    # Plugboard changes for the letter pair a, b: plugging, unplugging or
+    # swapping partners. Each is a list of pairs to plug (a letter plugged
+    # to itself is unplugged) and the letters whose partner changes.
+    x, y = plug[a], plug[b]
+    if x == b:
+        return [(((a, a), (b, b)), (a, b))]
+    elif x == a and y == b:
+        if sum(1 for i in range(26) if plug[i] > i) < max_pairs:
+            return [(((a, b),), (a, b))]
+        return []
+    elif y == b:
+        return [(((a, b), (x, x)), (a, b, x)), (((x, b), (a, a)), (a, b, x))]
+    elif x == a:
+        return [(((a, b), (y, y)), (a, b, y)), (((a, y), (b, b)), (a, b, y))]
+    else:
+        return [(((a, b), (x, y)), (a, b, x, y)), (((a, y), (b, x)), (a, b, x, y))]
+
+
+def climb(ciphertext, machine, table, max_pairs=10, seed=None, temperature=0.0, cooling=0.9, rounds=50):
+    # Hill climbing over plugboards, or simulated annealing if a starting
+    # temperature is given. The rotor settings of machine are taken as known
+    # and its plugboard is ignored. Returns (score, plugboard pairs).
+    np = import_numpy()
+    rng = Random(seed)
+    ciphertext = "".join(x for x in ciphertext.upper() if x in ALPHABET)
+    climber = PlugboardClimber(ciphertext, scrambler_table(machine, len(ciphertext)), table)
+
+    # Random plugboard to start from
+    plug = np.arange(26)
+    letters = list(range(26))
+    rng.shuffle(letters)
+    for i in range(rng.randint(0, max_pairs)):
+        a, b = letters[2*i], letters[2*i+1]
+        plug[a], plug[b] = b, a
+    climber.set_plug(plug)
+    best = (climber.score, climber.pairs())
+
+    letter_pairs = [(a, b) for a in range(26) for b in range(a+1, 26)]
+    for iteration in range(rounds):
+        improved = False
+        rng.shuffle(letter_pairs)
+        for a, b in letter_pairs:
+            for pairs, changed in moves(climber.plug, a, b, max_pairs):
+                plug = climber.plug.copy()
+                for x, y in pairs:
+                    plug[x], plug[y] = y, x
+                score, change = climber.trial(plug, list(changed))
+                delta = score - climber.score
+                if delta > 0 or (temperature > 0 and rng.random() < math.exp(delta/temperature)):
+                    climber.accept(score, change)
+                    improved = improved or delta > 0
+                    if climber.score > best[0]:
+                        best = (climber.score, climber.pairs())
+                    break
+
+        temperature *= cooling
+        if not improved and temperature < 1e-3:
+            break
+
+    return best
+
+
+def solve(ciphertext, machine, table, max_pairs=10, restarts=8, workers=None, **options):
+    # Runs climb from several random starting plugboards in worker processes
+    # and returns the best (score, plugboard pairs)
+    seeds = list(range(restarts))
+    if workers == 1:
+        results = [climb(ciphertext, machine, table, max_pairs, seed, **options) for seed in seeds]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(climb, ciphertext, machine, table, max_pairs, seed, **options)
+                       for seed in seeds]
+            results = [future.result() for future in futures]
+    return max(results)
@@ -0,0 +1,279 @@
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import struct
+import sys
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+from enigma import *
+from enigma_cli import KEY_OPTIONS, build_machine
+
+
+# Every frame is a 4 byte big-endian payload length, a 1 byte type and the
+# payload. Requests:
+#   OPEN    JSON object with the settings of a key file, and optionally
+#           "codec": "base32" or "radix26" for the data frames
+#   TEXT    UTF-8 text to encode
+#   DATA    bytes to encode with ArbitraryDataEnigma
+#   UNDATA  ciphertext of DATA to decode back to bytes
+#   STATE   empty, the reply is the rotor state
+#   CLOSE   empty, ends the session but not the connection
+# Every request gets a REPLY with the result or an ERROR with a message.
+HEADER = struct.Struct(">IB")
+OPEN, TEXT, DATA, UNDATA, STATE, CLOSE, REPLY, ERROR = b"OTDUSCRE"
+
+CODECS = {"base32": CODEC_BASE32, "radix26": CODEC_RADIX26}
+
+# Letters a codec makes of one byte at most: base32 gives 8 letters for 5
+# bytes and escapes add up to half of that again, radix-26 55 for 32
+LETTERS_PER_BYTE = {CODEC_BASE32: 2.4, CODEC_RADIX26: RADIX26_LETTERS / RADIX26_BLOCK}
+
+
+async def read_frame(reader):
+    header = await reader.readexactly(HEADER.size)
+    length, kind = HEADER.unpack(header)
+    return kind, length
+
+
+def write_frame(writer, kind, payload=b""):
+    writer.write(HEADER.pack(len(payload), kind) + payload)
+
+
+class MachinePool(object):
+    # Built machines by key, least recently used first, so sessions with a
+    # key seen before skip building and compiling. Holds at most maxsize
+    # machines, each with the snapshot of its start position.
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._machines = OrderedDict()
+        self._count = 0
+
+    def acquire(self, key):
+        machines = self._machines.get(key)
+        if machines:
+            machine, start = machines.pop()
+            self._count -= 1
+            if not machines:
+                del self._machines[key]
+            machine.restore(start)
+            return machine, start
+        # Building and compiling a machine takes about 50us, less than handing 
+        # it to a thread would cost, so it stays on the event loop
+        machine = build_machine(dict(key))
+        return machine, machine.snapshot()
+
+    def release(self, key, machine, start):
+        self._machines.setdefault(key, []).append((machine, start))
+        self._machines.move_to_end(key)
+        self._count += 1
+        while self._count > self.maxsize:
+            oldest = next(iter(self._machines))
+            self._machines[oldest].pop(0)
+            self._count -= 1
+            if not self._machines[oldest]:
+                del self._machines[oldest]
+
+
+def _encode_text(machine, text):
+    result = machine.encode(text)
+    return result, machine.snapshot()
+
+
+def _encode_data(machine, codec, decode, data):
+    data_enigma = ArbitraryDataEnigma(machine, codec)
+    result = data_enigma.decode(data) if decode else data_enigma.encode(data)
+    return result, machine.snapshot()
+
+
+class Session(object):
+    def __init__(self, key, machine, start, codec):
+        self.key = key
+        self.machine = machine
+        self.start = start
+        self.codec = codec
+
+
+class EnigmaServer(object):
+    # Payloads up to offload_size letters, a few milliseconds of work, are
+    # encoded on the event loop, larger ones in a process pool. DATA frames
+    # count with the letters their bytes expand to. A connection sends its
+    # next request only after the reply was flushed, and at most max_jobs
+    # payloads are in the process pool at once, so slow clients and large
+    # payloads push back on their senders instead of piling up in memory.
+    def __init__(self, pool_size=1024, workers=None, max_frame=16*1024*1024, offload_size=2048,
+                 max_jobs=None):
+        self.pool = MachinePool(pool_size)
+        # Workers are started on demand, forked workers would inherit the
+        # sockets of the connections open at that time and keep them open
+        self.executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+        self.max_frame = max_frame
+        self.offload_size = offload_size
+        self.jobs = asyncio.Semaphore(max_jobs or 2*(workers or os.cpu_count() or 1))
+        self.sessions = 0
+
+    async def _run(self, session, letters, function, *args):
+        if letters <= self.offload_size:
+            result, snapshot = function(session.machine, *args)
+        else:
+            async with self.jobs:
+                loop = asyncio.get_running_loop()
+                result, snapshot = await loop.run_in_executor(self.executor, function, session.machine, *args)
+        session.machine.restore(snapshot)
+        return result
+
+    def _open(self, payload):
+        settings = json.loads(payload.decode("utf-8"))
+        codec = CODECS[settings.pop("codec", "base32")]
+        key = tuple(sorted((name, str(value)) for name, value in settings.items() if name in KEY_OPTIONS))
+        machine, start = self.pool.acquire(key)
+        return Session(key, machine, start, codec)
+
+    def _close(self, session):
+        if session is not None:
+            self.pool.release(session.key, session.machine, session.start)
+            self.sessions -= 1
+
+    async def request(self, session, kind, payload):
+        # Returns the session after the request and the reply payload
+        if kind == OPEN:
+            # The old session is only given back once the new one is open, if
+            # opening fails the connection keeps the old session
+            new_session = self._open(payload)
+            self._close(session)
+            self.sessions += 1
+            return new_session, b""
+        if kind == CLOSE:
+            self._close(session)
+            return None, b""
+        if session is None:
+            raise RuntimeError("No open session")
+        if kind == TEXT:
+            text = payload.decode("utf-8")
+            result = await self._run(session, len(text), _encode_text, text)
+            return session, result.encode("utf-8")
+        if kind == DATA:
+            letters = len(payload) * LETTERS_PER_BYTE[session.codec]
+            result = await self._run(session, letters, _encode_data, session.codec, False, payload)
+            return session, result.encode("ascii")
+        if kind == UNDATA:
+            result = await self._run(session, len(payload), _encode_data, session.codec, True,
+                                     payload.decode("ascii"))
+            return session, result
+        if kind == STATE:
+            return session, session.machine.get_rotor_state().encode("ascii")
+        raise RuntimeError("Unknown frame type: {0!r}".format(bytes([kind])))
+
+    async def handle(self, reader, writer):
+        session = None
+        try:
+            while True:
+                try:
+                    kind, length = await read_frame(reader)
+                except asyncio.IncompleteReadError:
+                    break
+                if length > self.max_frame:
+                    write_frame(writer, ERROR, b"Frame too large")
+                    break
+                payload = await reader.readexactly(length)
+                try:
+                    session, result = await self.request(session, kind, payload)
+                except Exception as error:
+                    write_frame(writer, ERROR, str(error).encode("utf-8"))
+                else:
+                    write_frame(writer, REPLY, result)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self._close(session)
+            writer.close()
+
+    def shutdown(self):
+        self.executor.shutdown()
+
+
+class EnigmaClient(object):
+    # Minimal client for the framed protocol
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+
+    @classmethod
+    async def connect(cls, host=None, port=None, path=None):
+        if path is not None:
+            reader, writer = await asyncio.open_unix_connection(path)
+        else:
+            reader, writer = await asyncio.open_connection(host, port)
+        return cls(reader, writer)
+
+    async def request(self, kind, payload=b""):
+        write_frame(self.writer, kind, payload)
+        await self.writer.drain()
+        reply, length = await read_frame(self.reader)
+        payload = await self.reader.readexactly(length)
+        if reply == ERROR:
+            raise RuntimeError(payload.decode("utf-8"))
+        return payload
+
+    async def open(self, **settings):
+        await self.request(OPEN, json.dumps(settings).encode("utf-8"))
+
+    async def encode(self, text):
+        return (await self.request(TEXT, text.encode("utf-8"))).decode("utf-8")
+
+    async def encode_data(self, data):
+        return (await self.request(DATA, data)).decode("ascii")
+
+    async def decode_data(self, text):
+        return await self.request(UNDATA, text.encode("ascii"))
+
+    async def get_rotor_state(self):
+        return (await self.request(STATE)).decode("ascii")
+
+    async def close(self):
+        await self.request(CLOSE)
+        self.writer.close()
+
+
+async def serve(server, host=None, port=None, path=None, backlog=4096):
+    # The default backlog of 100 would reset connections when thousands of
+    # clients connect at once
+    if path is not None:
+        listener = await asyncio.start_unix_server(server.handle, path, backlog=backlog)
+    else:
+        listener = await asyncio.start_server(server.handle, host, port, backlog=backlog)
+    async with listener:
+        await listener.serve_forever()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Enigma encryption service")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8426)
+    parser.add_argument("--unix", help="listen on this Unix socket instead of TCP")
+    parser.add_argument("--pool-size", type=int, default=1024, help="machines kept for reuse")
+    parser.add_argument("--workers", type=int, default=None, help="processes for large payloads")
+    parser.add_argument("--offload-size", type=int, default=2048,
+                        help="payloads of more letters than this are encoded in the process pool")
+    parser.add_argument("--max-frame", type=int, default=16*1024*1024)
+    args = parser.parse_args(argv)
+
+    async def run():
+        server = EnigmaServer(args.pool_size, args.workers, args.max_frame, args.offload_size)
+        try:
+            await serve(server, args.host, args.port, args.unix)
+        finally:
+            server.shutdown()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,253 @@
+import argparse
+import os
+import sys
+from collections import deque, namedtuple
+
+from enigma import *
+from enigma_cli import build_machine
+from enigma_keysheet import key_rows, read_keysheet
+
+
+# A message is its indicator, the message key encrypted at the ground
+# setting of the day (twice in a row with doubled indicators), followed by
+# the body encrypted with the rotors at the message key
+Intercept = namedtuple("Intercept", ["name", "indicator", "body"])
+Decrypt = namedtuple("Decrypt", ["name", "message_key", "text", "error"])
+
+
+def parse_intercept(name, text, length):
+    # The first length letters are the indicator, the rest is the body
+    count = 0
+    for i, letter in enumerate(text):
+        if letter.upper() in ALPHABET:
+            count += 1
+            if count == length:
+                indicator = "".join(x for x in text[:i+1].upper() if x in ALPHABET)
+                return Intercept(name, indicator, text[i+1:].strip())
+    return Intercept(name, "".join(x for x in text.upper() if x in ALPHABET), "")
+
+
+def read_intercepts(source, length):
+    # Intercepts from a directory with one message per file, named by file
+    # name, or from a file object with one message per line, named by line
+    # number. Read lazily, so a day of traffic can be streamed.
+    if isinstance(source, str):
+        for name in sorted(os.listdir(source)):
+            with open(os.path.join(source, name)) as f:
+                yield parse_intercept(name, f.read(), length)
+    else:
+        for number, line in enumerate(source, 1):
+            if line.strip():
+                yield parse_intercept(str(number), line, length)
+
+
+class GroundSetting(object):
+    # Substitutions of the machine at the ground setting for the key presses
+    # of an indicator. They are computed once, after that deciphering the
+    # indicators of all messages of the day is a lookup per letter.
+    def __init__(self, machine, doubled=True):
+        np = import_numpy()
+        self.machine = machine
+        self.doubled = doubled
+        self.key_length = len(machine.get_rotor_state())
+        self.length = self.key_length * (2 if doubled else 1)
+        self.permutations = machine.permutation_batch([machine.state.rotations], range(self.length))[0]
+
+    def message_keys(self, indicators):
+        # Message keys of the indicators, or None where an indicator is too
+        # short or the halves of a doubled indicator differ
+        np = import_numpy()
+        keys = [None]*len(indicators)
+        valid = [i for i, indicator in enumerate(indicators) if len(indicator) == self.length]
+        if not valid:
+            return keys
+        codes = np.array([list(offsets(indicators[i])) for i in valid], dtype=np.intp)
+        letters = self.permutations[np.arange(self.length), codes]
+        if self.doubled:
+            agree = (letters[:, :self.key_length] == letters[:, self.key_length:]).all(axis=1)
+        else:
+            agree = np.ones(len(valid), dtype=bool)
+        alphabet = np.frombuffer(ALPHABET.encode("ascii"), dtype=np.uint8)
+        text = alphabet[letters[:, :self.key_length]]
+        for i, ok, key in zip(valid, agree.tolist(), text):
+            if ok:
+                keys[i] = key.tobytes().decode("ascii")
+        return keys
+
+
+_ground_settings = {}
+
+
+def ground_setting(key, doubled=True, cache=None):
+    # GroundSetting of the settings of a key file, whose state is the ground
+    # setting, kept for every key seen before
+    name = (tuple(sorted(key.items())), doubled)
+    if name not in _ground_settings:
+        _ground_settings[name] = GroundSetting(build_machine(key, cache), doubled)
+    return _ground_settings[name]
+
+
+def _decrypt_bodies(machine, messages):
+    # Bodies of (message key, body) pairs, every one from its own message
+    # key. The rotor positions of every message are laid out from its
+    # stepping events like encode_vectorized does, only for the key presses
+    # of its own body, and all key presses of the batch are substituted at
+    # once.
+    np = import_numpy()
+    if not messages:
+        return []
+    entry, output, forward, backward, reflector, stepping = machine.tables()
+    notches = machine.notches()
+
+    lengths = [len(body) for message_key, body in messages]
+    data = np.frombuffer("".join(body for message_key, body in messages).encode("utf-32-le"), dtype=np.uint32)
+    unique, inverse = np.unique(data, return_inverse=True)
+    codes = np.array([key_code(chr(x)) for x in unique], dtype=np.intp)[inverse.ravel()]
+
+    # Key presses of every message, in the order of the messages
+    keys = np.flatnonzero(codes >= 0)
+    rows = np.repeat(np.arange(len(messages)), lengths)[keys]
+    counts = np.bincount(rows, minlength=len(messages)).tolist()
+
+    positions = []
+    reflections = []
+    for (message_key, body), count in zip(messages, counts):
+        machine.set_rotor_state(message_key)
+        positions.append(offset_positions(machine.get_offsets(), notches, stepping, count))
+        reflections.append(machine.reflector.offset(machine.state.reflector))
+    positions = np.concatenate(positions, axis=1)
+    reflections = np.repeat(np.array(reflections, dtype=np.intp), counts)
+
+    forward = np.asarray(forward, dtype=np.intp)
+    backward = np.asarray(backward, dtype=np.intp)
+    letters = np.asarray(entry, dtype=np.intp)[codes[keys]]
+    for i in range(len(positions)):
+        letters = forward[i, positions[i], letters]
+    letters = np.asarray(reflector, dtype=np.intp)[reflections, letters]
+    for i in range(len(positions)-1, -1, -1):
+        letters = backward[i, positions[i], letters]
+
+    result = data.copy()
+    result[keys] = np.frombuffer(output.encode("ascii"), dtype=np.uint8)[letters]
+    text = result.tobytes().decode("utf-32-le")
+    bounds = np.cumsum([0] + lengths).tolist()
+    return [text[bounds[i]:bounds[i+1]] for i in range(len(messages))]
+
+
+def _decrypt_batch(ground, batch):
+    # Message keys of a batch of intercepts, and the pairs for _decrypt_bodies
+    keys = ground.message_keys([intercept.indicator for intercept in batch])
+    return keys, [(key, intercept.body) for key, intercept in zip(keys, batch) if key is not None]
+
+
+def _results(ground, batch, keys, texts):
+    texts = iter(texts)
+    for intercept, key in zip(batch, keys):
+        if key is None:
+            error = "Indicator {0} does not decipher to a {1}message key".format(
+                intercept.indicator, "doubled " if ground.doubled else "")
+            yield Decrypt(intercept.name, None, None, error)
+        else:
+            yield Decrypt(intercept.name, key, next(texts), None)
+
+
+def _batches(intercepts, size):
+    batch = []
+    for intercept in intercepts:
+        batch.append(intercept)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def decrypt_traffic(key, intercepts, doubled=True, workers=None, batch_size=512, cache=None):
+    # Decrypts the intercepts of a day with the settings of a key file, whose
+    # state is the ground setting. Indicators are deciphered from the cached
+    # GroundSetting a batch at a time, and the bodies of the batches are
+    # decrypted in worker processes unless workers is 1, each worker with a
+    # copy of the machine. Yields a Decrypt for every intercept in input
+    # order as the batches finish, with at most two batches per worker in
+    # flight, so the intercepts can be read and the results written as a
+    # stream.
+    ground = ground_setting(key, doubled, cache)
+    machine = ground.machine.clone()
+    batches = _batches(intercepts, batch_size)
+    if workers == 1:
+        for batch in batches:
+            keys, messages = _decrypt_batch(ground, batch)
+            yield from _results(ground, batch, keys, _decrypt_bodies(machine, messages))
+        return
+
+    # Imported here like in EnigmaMachine.encode_parallel
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        limit = 2*(workers or os.cpu_count() or 1)
+        pending = deque()
+        for batch in batches:
+            keys, messages = _decrypt_batch(ground, batch)
+            pending.append((batch, keys, executor.submit(_decrypt_bodies, machine, messages)))
+            if len(pending) >= limit:
+                batch, keys, future = pending.popleft()
+                yield from _results(ground, batch, keys, future.result())
+        while pending:
+            batch, keys, future = pending.popleft()
+            yield from _results(ground, batch, keys, future.result())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Decrypts a day of traffic with the key of a key sheet")
+    parser.add_argument("keysheet", help="CSV key sheet, the state column is the ground setting")
+    parser.add_argument("intercepts", nargs="?", default="-",
+                        help="directory with one message per file, or file with one message per line, "
+                             "stdin by default")
+    parser.add_argument("--day", type=int, default=1, help="row of the key sheet, counting from 1")
+    parser.add_argument("--single", action="store_true", help="indicators hold the message key only once")
+    parser.add_argument("-o", "--output", help="output file, stdout by default")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--batch-size", type=int, default=512, help="messages per worker job")
+    parser.add_argument("--cache-dir", help="directory of the compiled table cache, $ENIGMA_CACHE_DIR or "
+                                            "~/.cache/enigma by default")
+    parser.add_argument("--no-cache", action="store_true", help="always build the tables")
+    args = parser.parse_args(argv)
+
+    keys = list(key_rows(read_keysheet(args.keysheet)))
+    if not 1 <= args.day <= len(keys):
+        parser.error("The key sheet has {0} days".format(len(keys)))
+    key = keys[args.day-1]
+    if "state" not in key:
+        parser.error("The key sheet has no ground setting for day {0}".format(args.day))
+    cache = None if args.no_cache else TableCache(args.cache_dir)
+
+    ground = ground_setting(key, not args.single, cache)
+    if args.intercepts == "-":
+        source = sys.stdin
+    elif os.path.isdir(args.intercepts):
+        source = args.intercepts
+    else:
+        source = open(args.intercepts)
+    dst = open(args.output, "w") if args.output else sys.stdout
+
+    # Results are written as name, message key and text, one per line with
+    # whitespace runs as single spaces, and messages whose indicator is
+    # garbled are reported on stderr
+    failures = 0
+    try:
+        intercepts = read_intercepts(source, ground.length)
+        for result in decrypt_traffic(key, intercepts, not args.single, args.workers, args.batch_size, cache):
+            if result.error is not None:
+                print("{0}: {1}".format(result.name, result.error), file=sys.stderr)
+                failures += 1
+            else:
+                dst.write("{0}\t{1}\t{2}\n".format(result.name, result.message_key, " ".join(result.text.split())))
+    finally:
+        if dst is not sys.stdout:
+            dst.close()
+        if source is not sys.stdin and not isinstance(source, str):
+            source.close()
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())